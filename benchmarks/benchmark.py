@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark
+    ~~~~~~~~~
+
+    Benchmark for rendering seqdiag diagrams in sphinx-build.
+
+    This generates a synthetic project (N pages x M diagrams) and measures
+    cold build, warm rebuild (all pages are re-read; the rendered images are
+    reused), single-page incremental rebuild and parallel build for each
+    image format.  Each build runs in a separate process to
+    measure its peak RSS.
+
+    Usage::
+
+        $ python benchmarks/benchmark.py --pages 20 --diagrams 10 --formats png,svg,pdf \
+              --fontpath /path/to/font.ttf
+
+    :copyright: Copyright 2010 by Takeshi Komiya.
+    :license: BSDL.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+CONF_PY = """\
+extensions = ['sphinxcontrib.seqdiag']
+master_doc = 'index'
+latex_documents = [('index', 'benchmark.tex', 'benchmark', 'benchmark', 'manual')]
+seqdiag_html_image_format = %(html_format)r
+seqdiag_latex_image_format = %(latex_format)r
+seqdiag_fontpath = %(fontpath)r
+"""
+
+# builder and image format for each benchmark target
+TARGETS = {
+    'png': ('html', 'PNG', 'PNG'),
+    'svg': ('html', 'SVG', 'PNG'),
+    'pdf': ('latex', 'PNG', 'PDF'),
+}
+
+
+def generate_diagram(rand, pagenum, index):
+    actors = ['actor%d' % i for i in range(rand.randint(2, 8))]
+
+    lines = []
+    for i in range(rand.randint(2, 30)):
+        src, dest = rand.sample(actors, 2)
+        if i % 5 == 4:
+            lines.append('%s -> %s [label = "message %d", note = "note %d"];' % (src, dest, i, i))
+        else:
+            lines.append('%s -> %s [label = "message %d"];' % (src, dest, i))
+
+    # clickable actors
+    for actor in rand.sample(actors, rand.randint(0, 2)):
+        target = rand.randint(0, pagenum)
+        lines.append("%s [href = ':ref:`page%d`'];" % (actor, target))
+
+    # make every diagram unique
+    lines.append('%s [label = "page%d-%d"];' % (actors[0], pagenum, index))
+
+    return '.. seqdiag::\n\n   {\n%s\n   }\n' % '\n'.join('     ' + line for line in lines)
+
+
+def generate_page(rand, pagenum, diagrams, revision=0):
+    content = ['.. _page%d:' % pagenum, '',
+               'page %d (revision %d)' % (pagenum, revision), '=' * 40, '']
+    for i in range(diagrams):
+        content.append(generate_diagram(rand, pagenum, i + revision * diagrams))
+
+    return '\n'.join(content)
+
+
+def generate_project(srcdir, pages, diagrams, target, fontpath, seed):
+    _, html_format, latex_format = TARGETS[target]
+    with open(os.path.join(srcdir, 'conf.py'), 'w') as f:
+        f.write(CONF_PY % dict(html_format=html_format, latex_format=latex_format,
+                               fontpath=fontpath))
+
+    toctree = '\n'.join('   page%d' % i for i in range(pages))
+    with open(os.path.join(srcdir, 'index.rst'), 'w') as f:
+        f.write('.. _page%d:\n\nbenchmark\n=========\n\n.. toctree::\n\n%s\n' % (pages, toctree))
+
+    rand = random.Random(seed)
+    for i in range(pages):
+        with open(os.path.join(srcdir, 'page%d.rst' % i), 'w') as f:
+            f.write(generate_page(rand, i, diagrams))
+
+
+def sphinx_build(srcdir, outdir, buildername, jobs=1, fresh_env=False):
+    """Run sphinx-build in a child process; returns (elapsed, peak RSS in KiB)."""
+    # -W: diagrams failing to render are dropped with warnings; the results would be meaningless
+    args = [sys.executable, '-m', 'sphinx', '-q', '-W', '-b', buildername, '-j', str(jobs), srcdir, outdir]
+    if fresh_env:
+        args.insert(3, '-E')  # re-read all pages; otherwise a rebuild of unchanged sources does nothing
+    started = time.time()
+    proc = subprocess.Popen(args)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    elapsed = time.time() - started
+    proc.returncode = status
+    if status != 0:
+        raise RuntimeError('sphinx-build failed: %s' % ' '.join(args))
+
+    if sys.platform == 'darwin':
+        return elapsed, rusage.ru_maxrss // 1024  # bytes on macOS
+    else:
+        return elapsed, rusage.ru_maxrss
+
+
+def run_benchmark(options, target):
+    buildername = TARGETS[target][0]
+    workdir = tempfile.mkdtemp()
+    try:
+        srcdir = os.path.join(workdir, 'src')
+        os.mkdir(srcdir)
+        generate_project(srcdir, options.pages, options.diagrams, target, options.fontpath, options.seed)
+        total = options.pages * options.diagrams
+
+        results = []
+
+        def record(scenario, diagrams, elapsed, maxrss):
+            results.append(dict(format=target, scenario=scenario, diagrams=diagrams,
+                                elapsed=elapsed, diagrams_per_sec=diagrams / elapsed,
+                                peak_rss_kib=maxrss))
+            print('%-4s %-12s %6d diagrams %8.2f sec %8.1f diagrams/sec %8d KiB' %
+                  (target, scenario, diagrams, elapsed, diagrams / elapsed, maxrss))
+
+        outdir = os.path.join(workdir, 'out')
+        record('cold', total, *sphinx_build(srcdir, outdir, buildername))
+        record('warm', total, *sphinx_build(srcdir, outdir, buildername, fresh_env=True))
+
+        # modify all diagrams in one page
+        with open(os.path.join(srcdir, 'page0.rst'), 'w') as f:
+            f.write(generate_page(random.Random(options.seed), 0, options.diagrams, revision=1))
+        record('incremental', options.diagrams, *sphinx_build(srcdir, outdir, buildername))
+
+        for jobs in options.jobs:
+            outdir = os.path.join(workdir, 'out-j%d' % jobs)
+            record('parallel-j%d' % jobs, total, *sphinx_build(srcdir, outdir, buildername, jobs))
+
+        return results
+    finally:
+        shutil.rmtree(workdir)
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='benchmark for sphinxcontrib-seqdiag')
+    parser.add_argument('--pages', type=int, default=10, help='number of pages (default: 10)')
+    parser.add_argument('--diagrams', type=int, default=10, help='number of diagrams per page (default: 10)')
+    parser.add_argument('--formats', default='png,svg', help='comma separated formats: png, svg, pdf')
+    parser.add_argument('--jobs', default='%d' % (os.cpu_count() or 1),
+                        help='comma separated numbers of parallel jobs (default: number of CPUs)')
+    parser.add_argument('--fontpath', default=None, help='TrueType font (required for PDF)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for generating diagrams')
+    parser.add_argument('--output', default=None, help='write results as JSON to this file')
+    options = parser.parse_args(args)
+    options.jobs = [int(n) for n in options.jobs.split(',') if n]
+
+    results = []
+    for target in options.formats.lower().split(','):
+        if target not in TARGETS:
+            parser.error('unknown format: %s' % target)
+        elif target == 'pdf' and not options.fontpath:
+            parser.error('--fontpath is required for pdf format')
+
+        results.extend(run_benchmark(options, target))
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,151 +14,709 @@ from __future__ import absolute_import
 
 import os
 import re
+import sys
+import csv
+import gzip
+import html
+import json
+import time
+import atexit
+import base64
+import pickle
+import shutil
 import posixpath
 import traceback
-import pkg_resources
-from collections import namedtuple
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+from hashlib import sha1
+from io import BytesIO
 from docutils import nodes
+from docutils.parsers import rst
 from sphinx import addnodes
-from sphinx.util import logging
+from sphinx.util import logging, status_iterator
 from sphinx.util.osutil import ensuredir
 
-import seqdiag.utils.rst.nodes
-import seqdiag.utils.rst.directives
-from blockdiag.utils.bootstrap import detectfont, Application
-from blockdiag.utils.fontmap import FontMap
-from blockdiag.utils.rst.directives import with_blockdiag
+# Note: rendering stack (seqdiag.drawer, blockdiag.utils.bootstrap, PIL and so on)
+# is imported on demand to keep loading this extension cheap.
+import blockdiag
+import seqdiag
+from blockdiag.utils import Size
+from blockdiag.utils.fontmap import FontMap, parse_fontpath
 
-# fontconfig; it will be initialized on `builder-inited` event.
+# fontconfigs; they will be created on demand (keyed by fontpath and fontmap).
+fontmaps = {}
+
+# fontconfig used in worker processes; it is given from the parent process.
 fontmap = None
 
+# process pool for rendering diagrams; it will be created on demand.
+render_pool = None
+
+# images whose rendering timed out; they are not rendered again in the build
+timed_out_images = set()
+
+# availability of optional renderers; {format: bool}; they are reset on each build.
+capabilities = {}
+
+# TrueType fonts shared between PDF drawers; {path: TTFont}
+pdf_fonts = {}
+
+# memo of rendered SVG images; {key: (svg, pagesize)}
+# (evicted images are read from the cache on disk, or rendered again)
+svg_images = {}
+MAX_SVG_IMAGES = 256
+
+# memo of parsed diagrams; {key: pickled (code, tree)}
+# (only the results of the parser are kept; diagrams are built from them on each use
+# because the builder also resets the defaults of diagram elements kept in class attributes)
+parsed_diagrams = {}
+MAX_PARSED_DIAGRAMS = 1024
+
+# directory to store parsed diagrams; it is set on each build (and passed to render workers).
+# It is always in the doctree directory (not in seqdiag_cache_dir which might be shared)
+# because pickles are loaded from there; it is trusted as well as pickled doctrees.
+diagram_cachedir = None
+
+# resolved :ref: links; {(docname, refid): href}; they are reset on each build.
+resolved_references = {}
+undefined_labels = set()
+
+# pattern of :ref: links in href attributes
+reference = re.compile("^:ref:`(.+?)`", re.UNICODE)
+
+# render servers which could not be connected; diagrams are rendered locally instead
+unavailable_servers = set()
+
+# patterns for minifying SVG images
+svg_tag = re.compile(r'<(\w+)((?:\s+[\w:-]+="[^"]*")*)\s*(/?)>')
+svg_attribute = re.compile(r'([\w:-]+)="([^"]*)"')
+svg_number = re.compile(r'-?\d+\.\d+')
+svg_color = re.compile(r'rgb\((\d+),(\d+),(\d+)\)')
+svg_text = re.compile(r'<text\b[^>]*>([^<]*)</text>')
+
+# presentation attributes of SVG elements; they are moved to shared <style> on minifying
+SVG_STYLE_ATTRIBUTES = ('fill', 'fill-opacity', 'font-family', 'font-size', 'font-style',
+                        'font-weight', 'opacity', 'stroke', 'stroke-dasharray', 'stroke-width',
+                        'style', 'text-anchor')
+
+# geometry attributes of SVG elements; numbers in them are rounded on minifying
+# (the others, like links and ids, are kept as is)
+SVG_GEOMETRY_ATTRIBUTES = ('cx', 'cy', 'd', 'height', 'points', 'r', 'rx', 'ry', 'stdDeviation',
+                           'textLength', 'transform', 'viewBox', 'width', 'x', 'x1', 'x2', 'y', 'y1', 'y2')
+
+# raster formats for HTML; they are converted from PNG images (PNG is used as fallback)
+PICTURE_FORMATS = {'WEBP': 'image/webp', 'AVIF': 'image/avif'}
+
+# how diagrams are shown on the builders which can not display images; others render images.
+# (overridden by seqdiag_builder_capabilities)
+#   'image': render diagrams as images
+#   'alt': replace diagrams by their alt text (or their source code if alt is not given)
+#   'none': remove diagrams
+BUILDER_CAPABILITIES = {
+    'changes': 'none',
+    'dummy': 'none',
+    'gettext': 'none',
+    'linkcheck': 'none',
+    'man': 'alt',
+    'pseudoxml': 'alt',
+    'text': 'alt',
+    'xml': 'alt',
+}
+
+# lock files older than this (in seconds) are considered stale
+LOCK_EXPIRES = 600
+
+# file names of rendered images; seqdiag-<hash>.<format>
+image_filename = re.compile(r'^(seqdiag-[0-9a-f]{40}(?:@2x)?\.\w+)(\.json)?$')
+
+RenderJob = namedtuple('RenderJob', ('code options image_format filename '
+                                     'antialias transparency references '
+                                     'docname line profile server output_options max_pixels extras sidecar'))
+RenderServer = namedtuple('RenderServer', 'address fontpath fontmap timeout')
+
 logger = logging.getLogger(__name__)
 
 
-class seqdiag_node(seqdiag.utils.rst.nodes.seqdiag):
-    def to_drawer(self, image_format, builder, **kwargs):
-        if 'filename' in kwargs:
-            filename = kwargs.pop('filename')
+class seqdiag_node(nodes.General, nodes.Element):
+    name = 'seqdiag'
+
+    def to_diagram(self, stopwatch=None):
+        from seqdiag import builder, parser
+
+        cached = load_parsed_tree(self['code'])
+        if cached:
+            self['code'], tree = cached
         else:
-            filename = self.get_abspath(image_format, builder)
+            source = self['code']
+            try:
+                tree = parser.parse_string(self['code'])
+            except Exception:
+                code = '%s { %s }' % (self.name, self['code'])
+                tree = parser.parse_string(code)
+                self['code'] = code  # replace if succeeded
+
+            store_parsed_tree(source, self['code'], tree)
+
+        if stopwatch:
+            stopwatch.lap('parse')
+
+        return builder.ScreenNodeBuilder.build(tree)
 
-        antialias = builder.config.seqdiag_antialias
-        transparency = builder.config.seqdiag_transparency
-        image = super(seqdiag_node, self).to_drawer(image_format, filename, fontmap,
-                                                    antialias=antialias, transparency=transparency,
-                                                    **kwargs)
-        for node in image.diagram.traverse_nodes():
-            node.href = resolve_reference(builder, node.href)
+    def create_drawer(self, image_format, filename, fontmap, stopwatch=None, **kwargs):
+        from seqdiag import drawer
+
+        if image_format == 'PDF':
+            share_pdf_fonts()
+        elif image_format == 'PNG' and kwargs.get('max_pixels'):
+            bound_png_canvas()
+
+        image = drawer.DiagramDraw(image_format, self.to_diagram(stopwatch), filename,
+                                   fontmap=fontmap, **kwargs)
+        if stopwatch:
+            stopwatch.lap('layout')
 
         return image
 
-    def get_relpath(self, image_format, builder):
+    def get_relpath(self, image_format, builder, **kwargs):
         options = dict(antialias=builder.config.seqdiag_antialias,
                        fontpath=builder.config.seqdiag_fontpath,
                        fontmap=builder.config.seqdiag_fontmap,
                        format=image_format,
-                       transparency=builder.config.seqdiag_transparency)
+                       transparency=builder.config.seqdiag_transparency,
+                       **kwargs)
+        output_options = get_output_options(builder, image_format)
+        if output_options:
+            options['output'] = sorted(output_options.items())
         if hasattr(builder, 'imgpath'):  # Sphinx (<= 1.2.x) or HTML writer
             outputdir = builder.imgpath
         else:
             outputdir = ''
         return posixpath.join(outputdir, self.get_path(**options))
 
-    def get_abspath(self, image_format, builder):
+    def get_path(self, **options):
+        options.update(self['options'])
+        hashseed = (self['code'] + str(options)).encode('utf-8')
+        hashed = sha1(hashseed).hexdigest()
+
+        filename = "%s-%s.%s" % (self.name, hashed, options['format'].lower())
+        outputdir = options.get('outputdir')
+        if outputdir:
+            filename = os.path.join(outputdir, filename)
+
+        return filename
+
+    def get_abspath(self, image_format, builder, **kwargs):
         options = dict(antialias=builder.config.seqdiag_antialias,
                        fontpath=builder.config.seqdiag_fontpath,
                        fontmap=builder.config.seqdiag_fontmap,
                        format=image_format,
-                       transparency=builder.config.seqdiag_transparency)
+                       transparency=builder.config.seqdiag_transparency,
+                       **kwargs)
+        output_options = get_output_options(builder, image_format)
+        if output_options:
+            options['output'] = sorted(output_options.items())
 
-        if hasattr(builder, 'imagedir'):  # Sphinx (>= 1.3.x)
-            outputdir = os.path.join(builder.outdir, builder.imagedir)
-        elif hasattr(builder, 'imgpath'):  # Sphinx (<= 1.2.x) and HTML writer
-            outputdir = os.path.join(builder.outdir, '_images')
-        else:
-            outputdir = builder.outdir
-        path = os.path.join(outputdir, self.get_path(**options))
+        path = os.path.join(get_outputdir(builder), self.get_path(**options))
         ensuredir(os.path.dirname(path))
 
         return path
 
+    def get_references(self, builder, external=False):
+        references = {}
+        if ':ref:' in self['code']:
+            for refid in re.findall(":ref:`(.+?)`", self['code'], re.UNICODE):
+                if external:  # refer from the image directory
+                    references[refid] = resolve_image_reference(builder, refid)
+                else:
+                    references[refid] = resolve_reference(builder, ':ref:`%s`' % refid)
+
+        return references
+
+    def to_job(self, image_format, builder, filename, docname=None, references=None, extras=True):
+        if references is None and image_format == 'SVG':
+            references = self.get_references(builder)
+        elif references is None:
+            references = {}  # links are not embedded to raster and PDF images
+        if extras:
+            extra_jobs = tuple(get_extra_jobs(builder, self, image_format, docname))
+        else:
+            extra_jobs = ()
+
+        return RenderJob(self['code'], dict(self['options']), image_format, filename,
+                         builder.config.seqdiag_antialias,
+                         builder.config.seqdiag_transparency,
+                         references,
+                         docname, self.line, get_profile_dir(builder),
+                         get_render_server(builder), get_output_options(builder, image_format),
+                         builder.config.seqdiag_max_pixels, extra_jobs,
+                         has_sidecar(builder, image_format))
+
+
+def get_outputdir(builder):
+    if hasattr(builder, 'imagedir'):  # Sphinx (>= 1.3.x)
+        return os.path.join(builder.outdir, builder.imagedir)
+    elif hasattr(builder, 'imgpath'):  # Sphinx (<= 1.2.x) and HTML writer
+        return os.path.join(builder.outdir, '_images')
+    else:
+        return builder.outdir
+
+
+def application():
+    from blockdiag.utils.bootstrap import Application
+    return Application()
+
+
+def lazy_option(name):
+    """Refer an option converter of blockdiag directive on demand."""
+    def converter(argument):
+        from blockdiag.utils.rst import directives
+        return getattr(directives, name)(argument)
+
+    return converter
+
+
+class Seqdiag(rst.Directive):
+    """Directive to insert seqdiag diagrams.
+
+    This delegates to seqdiag.utils.rst.directives.SeqdiagDirective, which is
+    imported on the first use.
+    """
+    has_content = True
+    required_arguments = 0
+    optional_arguments = 1
+    final_argument_whitespace = False
+    option_spec = {
+        'alt': rst.directives.unchanged,
+        'height': rst.directives.length_or_unitless,
+        'width': rst.directives.length_or_percentage_or_unitless,
+        'scale': rst.directives.percentage,
+        'align': lazy_option('align'),
+        'caption': rst.directives.unchanged,
+        'desctable': rst.directives.flag,
+        'maxwidth': rst.directives.nonnegative_int,  # deprecated
+        'name': rst.directives.unchanged,
+        'class': rst.directives.class_option,
+        'figwidth': lazy_option('figwidth_value'),
+        'figclass': rst.directives.class_option,
+    }
+
+    directive_class = None
+
+    def run(self):
+        if Seqdiag.directive_class is None:
+            from seqdiag.utils.rst.directives import SeqdiagDirective
+
+            class SeqdiagDirectiveImpl(SeqdiagDirective):
+                node_class = seqdiag_node
+
+                def node2diagram(self, node):
+                    # keep the code as written; it might be wrapped by "seqdiag { }" on parsing
+                    node['rawcode'] = node['code']
+                    return super(SeqdiagDirectiveImpl, self).node2diagram(node)
 
-class Seqdiag(seqdiag.utils.rst.directives.SeqdiagDirective):
-    node_class = seqdiag_node
+                def node2image(self, node, diagram):
+                    return node
 
-    def node2image(self, node, diagram):
-        return node
+            Seqdiag.directive_class = SeqdiagDirectiveImpl
+
+        directive = self.directive_class(self.name, self.arguments, self.options, self.content,
+                                         self.lineno, self.content_offset, self.block_text,
+                                         self.state, self.state_machine)
+        results = directive.run()
+        for result in results:
+            for node in result.traverse(seqdiag_node):
+                node.source, node.line = self.state_machine.get_source_and_line(self.lineno)
+
+        return results
 
 
 def resolve_reference(builder, href):
     if href is None:
         return None
 
-    pattern = re.compile("^:ref:`(.+?)`", re.UNICODE)
-    matched = pattern.search(href)
+    matched = reference.search(href)
     if matched is None:
         return href
     elif not hasattr(builder, 'current_docname'):  # ex. latex builder
         return matched.group(1)
-    else:
-        refid = matched.group(1)
+
+    refid = matched.group(1)
+    key = (builder.current_docname, refid)
+    if key not in resolved_references:
         domain = builder.env.domains['std']
         node = addnodes.pending_xref(refexplicit=False)
         xref = domain.resolve_xref(builder.env, builder.current_docname, builder,
                                    'ref', refid, node, node)
         if xref:
             if 'refid' in xref:
-                return "#" + xref['refid']
+                resolved_references[key] = "#" + xref['refid']
             else:
-                return xref['refuri']
+                resolved_references[key] = xref['refuri']
         else:
+            if refid not in undefined_labels:  # warn only once per label
+                logger.warning('undefined label: %s', refid)
+                undefined_labels.add(refid)
+            resolved_references[key] = None
+
+    return resolved_references[key]
+
+
+def resolve_image_reference(builder, refid):
+    """Resolve a :ref: link as a relative URL from the image directory."""
+    std = builder.env.get_domain('std')
+    if refid not in std.data['anonlabels']:
+        if refid not in undefined_labels:  # warn only once per label
             logger.warning('undefined label: %s', refid)
-            return None
+            undefined_labels.add(refid)
+        return None
+
+    docname, labelid = std.data['anonlabels'][refid]
+    uri = builder.get_target_uri(docname)
+    if labelid:
+        uri += '#' + labelid
+
+    return posixpath.relpath(uri, builder.imagedir)
+
+
+def get_svg_image(builder, node):
+    """Render a diagram as SVG; results are memoized on memory and disk."""
+    # SVG images embed resolved references; they are also mixed into the key
+    references = sorted(node.get_references(builder).items())
+    key = get_cache_key(posixpath.basename(node.get_relpath('SVG', builder)), str(references))
+    if key in svg_images:
+        render_extra_images(builder, get_extra_jobs(builder, node, 'SVG'))
+        return svg_images[key]
+
+    cachepath = os.path.join(get_diagram_cachedir(builder), key + '.json')
+    try:
+        with open(cachepath, encoding='utf-8') as f:
+            cached = json.load(f)
+            image = (cached['svg'], Size(*cached['pagesize']))
+
+        os.utime(cachepath)  # mark as recently used
+        render_extra_images(builder, get_extra_jobs(builder, node, 'SVG'))
+        return memoize_svg_image(key, image)
+    except (OSError, ValueError, KeyError):
+        pass
+
+    stopwatch = Stopwatch()
+    job = node.to_job('SVG', builder, None)
+    rendered = job.server and request_render(job, inline=True)
+    if rendered:
+        data, metadata = rendered
+        svg = data.decode('utf-8')
+        stopwatch.lap('draw')
+    elif builder.config.seqdiag_render_timeout:
+        result = get_render_pool(builder).apply_async(render_inline_svg, (job,))
+        svg, metadata = wait_render_result(builder, result)
+        stopwatch.lap('draw')
+    else:
+        svg, metadata = render_inline_svg(job, get_fontmap(builder), stopwatch)
+    pagesize = Size(*metadata['pagesize'])
+
+    if job.output_options:
+        svg = postprocess_svg(svg, job.output_options, get_fontmap(builder))
+        stopwatch.lap('save')
+    record_profile(get_profile_dir(builder), getattr(builder, 'current_docname', None), node.line,
+                   key + '.svg', stopwatch, len(svg.encode('utf-8')))
+    render_extra_images(builder, job.extras)
+    try:
+        ensuredir(os.path.dirname(cachepath))
+        atomic_write(cachepath, json.dumps(dict(svg=svg, pagesize=list(pagesize))))
+    except OSError as exc:
+        logger.debug('seqdiag: could not store %s to cache: %s', cachepath, exc)
+
+    return memoize_svg_image(key, (svg, pagesize))
+
+
+def memoize_svg_image(key, image):
+    """Store the SVG image to the memo; the oldest ones are dropped over MAX_SVG_IMAGES."""
+    svg_images[key] = image
+    while len(svg_images) > MAX_SVG_IMAGES:
+        del svg_images[next(iter(svg_images))]
+
+    return image
+
+
+def render_extra_images(builder, extras):
+    """Render artefacts in other formats (seqdiag_render_formats) unless rendered yet."""
+    for extra in extras:
+        try:
+            if not os.path.isfile(extra.filename):
+                render_job(builder, extra)
+        except Exception as exc:
+            logger.debug('seqdiag: failed to render %s: %s', os.path.basename(extra.filename), exc)
+
+
+def render_inline_svg(job, _fontmap=None, stopwatch=None):
+    """Render a diagram as SVG to embed to HTML; returns (svg, metadata)."""
+    with application():
+        node = seqdiag_node(code=job.code, options=job.options)
+        image = node.create_drawer('SVG', None, _fontmap or fontmap, stopwatch, antialias=job.antialias,
+                                   transparency=job.transparency, nodoctype=True)
+        metadata = get_image_metadata(image)
+        substitute_references(image, job.references)
+        image.draw()
+        if stopwatch:
+            stopwatch.lap('draw')
+
+        size = image.pagesize().resize(**node['options'])
+        svg = image.save(size)
+        if stopwatch:
+            stopwatch.lap('save')
+
+        return svg, metadata
 
 
 def html_render_svg(self, node):
-    image = node.to_drawer('SVG', self.builder, filename=None, nodoctype=True)
-    image.draw()
+    svg, pagesize = get_svg_image(self.builder, node)
 
     # align
     align = node['options'].get('align', 'default')
-    self.body.append('<div class="align-%s">' % align)
+    if self.builder.config.seqdiag_html_image_loading == 'lazy':
+        # skip rendering until scrolled into view; the size is reserved to avoid layout shift
+        size = pagesize.resize(**node['options'])
+        style = 'content-visibility: auto; contain-intrinsic-size: %gpx %gpx' % (size.width, size.height)
+        self.body.append('<div class="align-%s" style="%s">' % (align, style))
+    else:
+        self.body.append('<div class="align-%s">' % align)
     self.context.append('</div>\n')
 
     # reftarget
     for node_id in node['ids']:
         self.body.append('<span id="%s"></span>' % node_id)
 
-    # resize image
-    size = image.pagesize().resize(**node['options'])
-    self.body.append(image.save(size))
+    self.body.append(svg)
     self.context.append('')
 
 
-def html_render_clickablemap(self, image, width_ratio, height_ratio):
-    href_nodes = [node for node in image.nodes if node.href]
-    if not href_nodes:
-        return
-
-    self.body.append('<map name="map_%d">' % id(image))
-    for node in href_nodes:
-        x1, y1, x2, y2 = image.metrics.cell(node)
+def html_render_clickablemap(self, areas, mapname, width_ratio, height_ratio):
+    self.body.append('<map name="%s">' % mapname)
+    for cell, href in areas:
+        x1, y1, x2, y2 = cell
 
         x1 *= width_ratio
         x2 *= width_ratio
         y1 *= height_ratio
         y2 *= height_ratio
-        areatag = '<area shape="rect" coords="%s,%s,%s,%s" href="%s">' % (x1, y1, x2, y2, node.href)
+        areatag = ('<area shape="rect" coords="%s,%s,%s,%s" href="%s">' %
+                   (x1, y1, x2, y2, self.attval(href)))
         self.body.append(areatag)
 
     self.body.append('</map>')
 
 
-def html_render_png(self, node):
-    image = node.to_drawer('PNG', self.builder)
-    if not os.path.isfile(image.filename):
-        image.draw()
-        image.save()
+def get_map_name(self, filename):
+    """Get a name of <map> element; it is stable between builds and unique in the document."""
+    hashed = os.path.basename(filename)[len('seqdiag-'):][:16]
+    mapnames = self.__dict__.setdefault('seqdiag_mapnames', {})
+    count = mapnames[hashed] = mapnames.get(hashed, 0) + 1
+    if count == 1:
+        return 'map_%s' % hashed
+    else:
+        return 'map_%s_%d' % (hashed, count)  # same diagram appears twice or more
+
+
+def get_image_metadata(image):
+    """Get page size and clickable areas of the diagram (hrefs are not resolved)."""
+    areas = [dict(cell=list(image.metrics.cell(node)), href=node.href) for node in image.nodes if node.href]
+    return dict(pagesize=list(image.pagesize()), areas=areas)
+
+
+def load_image_metadata(filename):
+    try:
+        with open(filename + '.json', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def has_sidecar(builder, image_format):
+    """Check the metadata of the image is needed; only HTML builders read it (image maps and sizes)."""
+    return builder.format in ('html', 'slides') and image_format in ('PNG', 'SVG')
+
+
+def save_image_metadata(filename, metadata):
+    """Save metadata of the image to the sidecar file (<filename>.json)."""
+    try:
+        atomic_write(filename + '.json', json.dumps(metadata))
+    except OSError as exc:
+        logger.debug('seqdiag: could not save metadata of %s: %s', filename, exc)
+
+
+def get_rendered_image(builder, node, job):
+    """Render the image of the job unless rendered yet; returns its metadata."""
+    metadata = None
+    if is_rendered(builder, job.filename):
+        metadata = load_image_metadata(job.filename)
+
+    if metadata is None:
+        render_job(builder, job)
+        metadata = load_image_metadata(job.filename)
+        if metadata is None:  # rendered without metadata (by older version)
+            image = node.create_drawer(job.image_format, job.filename, get_fontmap(builder),
+                                       antialias=job.antialias, transparency=job.transparency)
+            metadata = get_image_metadata(image)
+            save_image_metadata(job.filename, metadata)
+
+        store_to_cache(builder, job.filename)
+
+    return metadata
+
+
+def get_svg_file_job(builder, node, docname=None, extras=True):
+    """Get a job to render the diagram as an external SVG file; returns (job, relpath).
+
+    :ref: links in the file are resolved from the image directory, so the file
+    is shared among documents.  They are also mixed into the filename.
+    """
+    references = node.get_references(builder, external=True)
+    options = {}
+    if references:
+        options['references'] = sorted(references.items())
+
+    filename = node.get_abspath('SVG', builder, **options)
+    job = node.to_job('SVG', builder, filename, docname, references, extras)
+    return job, node.get_relpath('SVG', builder, **options)
+
+
+def get_render_formats(builder):
+    return [image_format.upper() for image_format in builder.config.seqdiag_render_formats]
+
+
+def get_extra_jobs(builder, node, image_format, docname=None):
+    """Get jobs to render the diagram in seqdiag_render_formats besides *image_format*.
+
+    They are rendered together with the image from the same parsed diagram.
+    Nothing in the current output refers to them, so they are rendered into
+    the cache directly; the builders using them fetch them from there.
+    """
+    jobs = []
+    for extra_format in get_render_formats(builder):
+        if extra_format == image_format:
+            continue
+        elif extra_format == 'SVG':
+            if ':ref:' in node['code'] and builder.format not in ('html', 'slides'):
+                continue  # links in the SVG image can be resolved only by HTML builders
+
+            job, _ = get_svg_file_job(builder, node, docname, extras=False)
+        elif extra_format == 'PNG' or (extra_format == 'PDF' and is_format_available('PDF')):
+            filename = node.get_abspath(extra_format, builder)
+            job = node.to_job(extra_format, builder, filename, docname, extras=False)
+        else:
+            continue
+
+        jobs.append(job._replace(filename=get_cache_path(builder, job.filename)))
+
+    return jobs
+
+
+def save_svgz(filename):
+    """Save a gzip compressed copy of the SVG image (<filename>z)."""
+    if os.path.isfile(filename + 'z'):
+        return
+
+    try:
+        with atomic_file(filename + 'z') as tmpname:
+            with open(filename, 'rb') as src, open(tmpname, 'wb') as f:
+                with gzip.GzipFile(os.path.basename(filename), 'wb', fileobj=f, mtime=0) as dest:
+                    shutil.copyfileobj(src, dest)
+    except OSError as exc:
+        logger.debug('seqdiag: could not save %sz: %s', filename, exc)
+
+
+def html_render_svg_file(self, node):
+    job, relpath = get_svg_file_job(self.builder, node, self.builder.current_docname)
+    metadata = get_rendered_image(self.builder, node, job)
+    if self.builder.config.seqdiag_html_svgz:
+        save_svgz(job.filename)
+
+    fallback = None
+    if 'PNG' in get_render_formats(self.builder):
+        # PNG image is used as fallback for the browsers not supporting SVG
+        try:
+            filename = node.get_abspath('PNG', self.builder)
+            get_rendered_image(self.builder, node, node.to_job('PNG', self.builder, filename, extras=False))
+            fallback = node.get_relpath('PNG', self.builder)
+        except ImageTooLarge as exc:
+            logger.info('seqdiag: %s; PNG fallback is omitted', exc)
+        except Exception as exc:
+            logger.warning('seqdiag: could not render PNG fallback: %s', exc)
+
+    # align
+    align = node['options'].get('align', 'default')
+    self.body.append('<div class="align-%s">' % align)
+    self.context.append('</div>\n')
+
+    size = Size(*metadata['pagesize']).resize(**node['options'])
+    attrs = dict(width=size.width, height=size.height)
+    img_attrs = get_loading_attributes(self.builder)
+
+    if self.builder.config.seqdiag_html_svg_mode == 'img' and not metadata['areas']:
+        attrs.update(img_attrs, src=relpath)
+        if 'alt' in node['options']:
+            attrs['alt'] = node['options']['alt']
+
+        if fallback:
+            self.body.append('<picture><source srcset="%s" type="image/svg+xml" />' % self.attval(relpath))
+            attrs['src'] = fallback
+            self.body.append(self.starttag(node, 'img', '', empty=True, **attrs))
+            self.context.append('</picture>')
+        else:
+            self.body.append(self.starttag(node, 'img', '', empty=True, **attrs))
+            self.context.append('')
+    else:
+        # links in SVG images work only in <object> tag
+        self.body.append(self.starttag(node, 'object', '', data=relpath, type='image/svg+xml', **attrs))
+        if fallback:
+            img_attrs.update(attrs, src=fallback, alt=node['options'].get('alt', ''))
+            self.body.append(self.emptytag({}, 'img', '', **img_attrs))  # ids are given to <object>
+        else:
+            self.body.append(self.encode(node['options'].get('alt', '')))
+        self.context.append('</object>')
+
+
+def get_loading_attributes(builder):
+    """Get loading and decoding attributes of <img> tags."""
+    attrs = {}
+    if builder.config.seqdiag_html_image_loading:
+        attrs['loading'] = builder.config.seqdiag_html_image_loading
+    if builder.config.seqdiag_html_image_decoding:
+        attrs['decoding'] = builder.config.seqdiag_html_image_decoding
+
+    return attrs
+
+
+def get_variant_filename(filename, image_format):
+    """Get a filename of the image converted to *image_format*."""
+    return os.path.splitext(filename)[0] + '.' + image_format.lower()
+
+
+def convert_image(filename, image_format):
+    """Convert the PNG image to *image_format* unless converted yet."""
+    from PIL import Image
+
+    converted = get_variant_filename(filename, image_format)
+    if os.path.isfile(converted):
+        return
+
+    with atomic_file(converted) as tmpname:
+        image = Image.open(filename)
+        if image_format == 'WEBP':
+            image.save(tmpname, image_format, lossless=True)  # keep lines and texts sharp
+        else:
+            image.save(tmpname, image_format, quality=90)
+
+
+def html_render_png(self, node, image_format='PNG'):
+    filename = node.get_abspath('PNG', self.builder)
+    job = node.to_job('PNG', self.builder, filename, self.builder.current_docname)
+    metadata = get_rendered_image(self.builder, node, job)
+    srcset = job.output_options.get('srcset') and not metadata.get('downsampled')
+    if image_format in PICTURE_FORMATS:
+        convert_image(filename, image_format)
+        if srcset:
+            convert_image(get_hidpi_filename(filename), image_format)
 
     # align
     align = node['options'].get('align', 'default')
@@ -174,33 +732,59 @@ def html_render_png(self, node):
         self.context.append('')
 
     # <img> tag
-    original_size = image.pagesize()
+    original_size = Size(*metadata['pagesize'])
     resized = original_size.resize(**node['options'])
     img_attr = dict(src=relpath,
                     width=resized.width,
-                    height=resized.height)
+                    height=resized.height,
+                    **get_loading_attributes(self.builder))
+    if srcset:
+        img_attr['srcset'] = '%s 1x, %s 2x' % (relpath, get_hidpi_filename(relpath))
 
-    if any(node.href for node in image.nodes):
-        img_attr['usemap'] = "#map_%d" % id(image)
+    areas = [(area['cell'], resolve_reference(self.builder, area['href'])) for area in metadata['areas']]
+    areas = [(cell, href) for cell, href in areas if href]
+    if areas:
+        mapname = get_map_name(self, filename)
+        img_attr['usemap'] = "#" + mapname
 
         width_ratio = float(resized.width) / original_size.width
         height_ratio = float(resized.height) / original_size.height
-        html_render_clickablemap(self, image, width_ratio, height_ratio)
+        html_render_clickablemap(self, areas, mapname, width_ratio, height_ratio)
 
     if 'alt' in node['options']:
         img_attr['alt'] = node['options']['alt']
 
+    if image_format in PICTURE_FORMATS:
+        # PNG image is used as fallback
+        converted = get_variant_filename(relpath, image_format)
+        if srcset:
+            sources = '%s 1x, %s 2x' % (converted, get_hidpi_filename(converted))
+        else:
+            sources = converted
+
+        self.body.append('<picture><source srcset="%s" type="%s" />' %
+                         (self.attval(sources), PICTURE_FORMATS[image_format]))
+        self.context[-1] = '</picture>' + self.context[-1]
+
     self.body.append(self.starttag(node, 'img', '', empty=True, **img_attr))
 
 
-@with_blockdiag
 def html_visit_seqdiag(self, node):
     try:
-        image_format = get_image_format_for(self.builder)
-        if image_format.upper() == 'SVG':
-            html_render_svg(self, node)
-        else:
-            html_render_png(self, node)
+        with application():
+            image_format = get_image_format_for(self.builder)
+            if image_format.upper() == 'SVG':
+                if self.builder.config.seqdiag_html_svg_mode == 'inline':
+                    html_render_svg(self, node)
+                else:
+                    html_render_svg_file(self, node)
+            else:
+                try:
+                    html_render_png(self, node, image_format)
+                except ImageTooLarge as exc:
+                    # embedded to HTML directly; no image files to be collected
+                    logger.info('seqdiag: %s; rendered as SVG instead', exc)
+                    html_render_svg(self, node)
     except UnicodeEncodeError:
         if self.builder.config.seqdiag_debug:
             traceback.print_exc()
@@ -233,46 +817,1052 @@ def get_image_format_for(builder):
     else:
         image_format = 'PNG'
 
-    if image_format.upper() not in ('PNG', 'PDF', 'SVG'):
+    if image_format in PICTURE_FORMATS and builder.format in ('html', 'slides'):
+        if not is_format_available(image_format):
+            raise ImportError('Could not output %s format. Install Pillow with %s support.' %
+                              (image_format, image_format))
+    elif image_format.upper() not in ('PNG', 'PDF', 'SVG'):
         raise ValueError('unknown format: %s' % image_format)
 
-    if image_format.upper() == 'PDF':
+    if image_format.upper() == 'PDF' and not is_format_available('PDF'):
+        raise ImportError('Could not output PDF format. Install reportlab.')
+
+    return image_format
+
+
+def is_format_available(image_format):
+    if image_format not in capabilities:
+        if image_format == 'PDF':
+            try:
+                import reportlab  # NOQA: importing test
+                capabilities['PDF'] = True
+            except ImportError:
+                capabilities['PDF'] = False
+        else:
+            from PIL import Image
+            if image_format == 'AVIF':
+                try:
+                    import pillow_avif  # NOQA: AVIF plugin for Pillow (< 11.2)
+                except ImportError:
+                    pass
+
+            Image.init()
+            capabilities[image_format] = image_format in Image.SAVE
+
+    return capabilities[image_format]
+
+
+def share_pdf_fonts():
+    """Make PDF drawers reuse TrueType fonts loaded by other drawers in the process.
+
+    Loading a TrueType font takes most of the time to render a PDF image.
+    """
+    from blockdiag import imagedraw
+    from blockdiag.imagedraw.pdf import PDFImageDraw
+
+    if not imagedraw.drawers:
+        imagedraw.init_imagedrawers()
+    if getattr(imagedraw.drawers.get('pdf'), 'shares_fonts', False):
+        return
+
+    class SharedFontPDFImageDraw(PDFImageDraw):
+        shares_fonts = True
+
+        def set_font(self, font):
+            if font.path in pdf_fonts:
+                self.fonts.setdefault(font.path, pdf_fonts[font.path])
+
+            super(SharedFontPDFImageDraw, self).set_font(font)
+            pdf_fonts.setdefault(font.path, self.fonts[font.path])
+
+    imagedraw.install_imagedrawer('pdf', SharedFontPDFImageDraw)
+
+
+class ImageTooLarge(Exception):
+    """The canvas of the image exceeds seqdiag_max_pixels."""
+
+
+class RenderTimeout(Exception):
+    """Rendering the image exceeds seqdiag_render_timeout."""
+
+
+def bound_png_canvas():
+    """Make PNG drawers refuse to allocate a canvas larger than max_pixels option.
+
+    The size is checked before the canvas is allocated, so a huge diagram
+    fails without consuming its memory.
+    """
+    from blockdiag import imagedraw
+    from blockdiag.imagedraw.png import ImageDrawEx
+
+    if not imagedraw.drawers:
+        imagedraw.init_imagedrawers()
+    if getattr(imagedraw.drawers.get('png'), 'bounds_canvas', False):
+        return
+
+    class BoundedPNGImageDraw(ImageDrawEx):
+        bounds_canvas = True
+
+        def __init__(self, filename, **kwargs):
+            self.max_pixels = kwargs.get('max_pixels')
+            super(BoundedPNGImageDraw, self).__init__(filename, **kwargs)
+
+        def set_canvas_size(self, size):
+            # the canvas is enlarged by scale_ratio on drawing
+            width = size[0] * self.scale_ratio
+            height = size[1] * self.scale_ratio
+            if self.max_pixels and width * height > self.max_pixels:
+                raise ImageTooLarge('%dx%d pixels image exceeds seqdiag_max_pixels (%d)' %
+                                    (width, height, self.max_pixels))
+
+            super(BoundedPNGImageDraw, self).set_canvas_size(size)
+
+    imagedraw.install_imagedrawer('png', BoundedPNGImageDraw)
+
+
+def create_bounded_drawer(node, image_format, filename, _fontmap, antialias, max_pixels,
+                          stopwatch=None, **kwargs):
+    """Create a drawer whose canvas fits in *max_pixels*; returns (drawer, downsampled).
+
+    If the canvas in double resolution (for antialias) does not fit, the image
+    is drawn in single resolution instead.  ImageTooLarge is raised if even it
+    does not fit.
+    """
+    try:
+        image = node.create_drawer(image_format, filename, _fontmap, stopwatch,
+                                   antialias=antialias, max_pixels=max_pixels, **kwargs)
+        return image, False
+    except ImageTooLarge:
+        if not antialias:
+            raise
+
+    image = node.create_drawer(image_format, filename, _fontmap, stopwatch,
+                               antialias=False, max_pixels=max_pixels, **kwargs)
+    return image, True
+
+
+def get_canvas_usage(image):
+    """Get the size of the canvas of the raster image; returns (width, height, bytes)."""
+    canvas = getattr(image.drawer.target, '_image', None)
+    if canvas is None:
+        return None
+
+    width, height = canvas.size
+    return width, height, width * height * len(canvas.getbands())
+
+
+def get_peak_rss():
+    """Get the peak resident set size of the process in bytes (if supported)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss  # bytes on macOS
+    else:
+        return maxrss * 1024
+
+
+def report_memory_usage(filename, canvas, peak_rss):
+    """Report memory usage for rendering the image (on debug logging).
+
+    *peak_rss* is the peak RSS of the process before rendering; its growth is
+    caused by the image.
+    """
+    usage = []
+    if canvas:
+        usage.append('canvas %dx%d (%.1f MiB)' % (canvas[0], canvas[1], canvas[2] / 1048576.0))
+
+    current = get_peak_rss()
+    if current and peak_rss:
+        usage.append('peak RSS %.1f MiB (+%.1f MiB)' % (current / 1048576.0, (current - peak_rss) / 1048576.0))
+
+    if usage:
+        logger.debug('seqdiag: memory usage of %s: %s', os.path.basename(filename), ', '.join(usage))
+
+
+def get_cache_key(*args):
+    # the versions of renderers are also mixed into the key
+    hashseed = ':'.join(args + (seqdiag.__version__, blockdiag.__version__))
+    return sha1(hashseed.encode('utf-8')).hexdigest()
+
+
+def is_cache_enabled(config):
+    # images for seqdiag_render_formats are shared with other builders via the default cache
+    return bool(config.seqdiag_cache_dir or config.seqdiag_render_formats)
+
+
+def get_cache_path(builder, filename):
+    """Get a path of the image in seqdiag_cache_dir (or None if cache is disabled)."""
+    if not is_cache_enabled(builder.config):
+        return None
+
+    # filename contains the hash of code and options
+    basename = os.path.basename(filename)
+    cachedir = get_diagram_cachedir(builder)
+    return os.path.join(cachedir, get_cache_key(basename) + os.path.splitext(basename)[1])
+
+
+def is_rendered(builder, filename):
+    """Check the image has been rendered; it is fetched from the cache if possible."""
+    if os.path.isfile(filename):
+        return True
+
+    cachepath = get_cache_path(builder, filename)
+    if cachepath is None or not os.path.isfile(cachepath):
+        return False
+
+    try:
+        # fetch the image and its siblings (metadata and high resolution variant)
+        for src, dest in ((cachepath + '.json', filename + '.json'),
+                          (get_hidpi_filename(cachepath), get_hidpi_filename(filename)),
+                          (cachepath, filename)):
+            if os.path.isfile(src) and not os.path.isfile(dest):
+                atomic_copy(src, dest)
+
+        os.utime(cachepath)  # mark as recently used
+        return True
+    except OSError as exc:
+        logger.debug('seqdiag: could not fetch %s from cache: %s', filename, exc)
+        return False
+
+
+def store_to_cache(builder, filename):
+    cachepath = get_cache_path(builder, filename)
+    if cachepath is None:
+        return
+
+    try:
+        ensuredir(os.path.dirname(cachepath))
+        # store the siblings (metadata and high resolution variant) before the image itself
+        for src, dest in ((filename + '.json', cachepath + '.json'),
+                          (get_hidpi_filename(filename), get_hidpi_filename(cachepath)),
+                          (filename, cachepath)):
+            if os.path.isfile(src) and not os.path.isfile(dest):
+                atomic_copy(src, dest)
+    except OSError as exc:
+        logger.debug('seqdiag: could not store %s to cache: %s', filename, exc)
+
+
+def evict_cache(app):
+    """Remove least recently used files until each cache directory fits in seqdiag_cache_size."""
+    if not app.config.seqdiag_cache_size:
+        return
+
+    for cachedir in set([get_diagram_cachedir(app.builder), get_parsed_cachedir(app.builder)]):
+        if os.path.isdir(cachedir):
+            evict_cachedir(cachedir, app.config.seqdiag_cache_size)
+
+
+def evict_cachedir(cachedir, cache_size):
+    entries = []
+    for filename in os.listdir(cachedir):
+        path = os.path.join(cachedir, filename)
+        try:
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        except OSError:
+            pass
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= cache_size:
+            break
+
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def detect_font(fontpath, cachedir=None):
+    """Detect a font file from candidates; the result is also cached on disk."""
+    cachepath = None
+    if cachedir:
+        cachepath = os.path.join(cachedir, 'fonts.json')
         try:
-            import reportlab  # NOQA: importing test
+            with open(cachepath, encoding='utf-8') as f:
+                detected = json.load(f).get(json.dumps(fontpath))
+                if detected and os.path.isfile(parse_fontpath(detected)[0]):
+                    return detected
+        except (OSError, ValueError):
+            pass
+
+    from blockdiag.utils.bootstrap import detectfont
+
+    config = namedtuple('Config', 'font')(fontpath)
+    detected = detectfont(config)
+    if cachepath:
+        try:
+            ensuredir(cachedir)
+            try:
+                with open(cachepath, encoding='utf-8') as f:
+                    fonts = json.load(f)
+            except (OSError, ValueError):
+                fonts = {}
+
+            fonts[json.dumps(fontpath)] = detected
+            atomic_write(cachepath, json.dumps(fonts))
+        except OSError as exc:
+            logger.debug('seqdiag: could not store %s: %s', cachepath, exc)
+
+    return detected
+
+
+def load_fontmap(fontpath, fontmapfile, cachedir=None):
+    """Load a fontconfig; the result is memoized (keyed by fontpath and fontmap)."""
+    if isinstance(fontpath, str):
+        fontpath = [fontpath]
+
+    key = (tuple(fontpath or []), fontmapfile)
+    if key not in fontmaps:
+        started = time.time()
+        try:
+            _fontmap = FontMap(fontmapfile)
+        except Exception as exc:
+            logger.warning('seqdiag: could not load fontmap %s: %s', fontmapfile, exc)
+            _fontmap = FontMap(None)
+
+        if fontpath:
+            try:
+                _fontmap.set_default_font(detect_font(list(fontpath), cachedir))
+            except Exception as exc:
+                logger.warning('seqdiag: %s', exc)
+
+        fontmaps[key] = _fontmap
+        logger.debug('seqdiag: fonts are resolved in %.3f sec', time.time() - started)
+
+    return fontmaps[key]
+
+
+def get_fontmap(builder):
+    config = builder.config
+    return load_fontmap(config.seqdiag_fontpath, config.seqdiag_fontmap, get_diagram_cachedir(builder))
+
+
+def init_render_worker(_fontmap, cachedir=None):
+    global fontmap, diagram_cachedir
+    fontmap = _fontmap
+    diagram_cachedir = cachedir
+
+
+def get_diagram_cachedir(builder):
+    """Get a directory to store parsed diagrams and images; it is shared among builders."""
+    cachedir = builder.config.seqdiag_cache_dir or os.path.join(builder.doctreedir, 'seqdiag')
+    return os.path.join(builder.confdir, cachedir)
+
+
+def get_parsed_cachedir(builder):
+    """Get a directory to store parsed diagrams; it is private to the build."""
+    return os.path.join(builder.doctreedir, 'seqdiag')
+
+
+def load_parsed_tree(code):
+    """Load the parsed tree of the code from the memo or diagram_cachedir.
+
+    This returns a pair of the code (wrapped by "seqdiag { }" if needed) and
+    a new copy of the tree, or None if not parsed yet.  The trees are pickled,
+    so diagram_cachedir must be trusted (see get_parsed_cachedir()).
+    """
+    key = get_cache_key('tree', code)
+    if key not in parsed_diagrams and diagram_cachedir:
+        try:
+            path = os.path.join(diagram_cachedir, key + '.pickle')
+            with open(path, 'rb') as f:
+                parsed_diagrams[key] = f.read()
+
+            os.utime(path)  # mark as recently used
+        except OSError:
+            pass
+
+    if key not in parsed_diagrams:
+        return None
+
+    try:
+        return pickle.loads(parsed_diagrams[key])
+    except Exception as exc:
+        logger.debug('seqdiag: could not load parsed tree: %s', exc)
+        del parsed_diagrams[key]
+        return None
+
+
+def store_parsed_tree(source, code, tree):
+    """Store the parsed tree to the memo and diagram_cachedir."""
+    try:
+        data = pickle.dumps((code, tree), pickle.HIGHEST_PROTOCOL)
+    except Exception as exc:
+        logger.debug('seqdiag: could not pickle parsed tree: %s', exc)
+        return
+
+    # the code might be wrapped by "seqdiag { }"; the tree is found by both
+    for key in set([get_cache_key('tree', source), get_cache_key('tree', code)]):
+        parsed_diagrams[key] = data
+        if diagram_cachedir:
+            try:
+                ensuredir(diagram_cachedir)
+                atomic_write(os.path.join(diagram_cachedir, key + '.pickle'), data)
+            except OSError as exc:
+                logger.debug('seqdiag: could not store parsed tree: %s', exc)
+
+    while len(parsed_diagrams) > MAX_PARSED_DIAGRAMS:
+        del parsed_diagrams[next(iter(parsed_diagrams))]  # the oldest one
+
+
+def substitute_references(image, references):
+    """Replace :ref: links in the diagram by resolved ones."""
+    for node in image.diagram.traverse_nodes():
+        matched = reference.search(node.href or '')
+        if matched:
+            node.href = references.get(matched.group(1))
+
+
+def add_link_targets(svg):
+    """Make links in the SVG image open in the top window (not in <object> tag)."""
+    return svg.replace('<a xlink:href=', '<a target="_top" xlink:href=')
+
+
+def get_output_options(builder, image_format):
+    """Get enabled options for post-processing images; they are also mixed into filenames."""
+    config = builder.config
+    if image_format == 'SVG':
+        options = dict(minify=config.seqdiag_svg_minify,
+                       embed_font=config.seqdiag_svg_embed_font)
+    elif image_format == 'PNG':
+        options = dict(optimize=config.seqdiag_png_optimize,
+                       srcset=builder.format in ('html', 'slides') and config.seqdiag_html_png_srcset)
+    else:
+        options = {}
+
+    return dict((name, value) for name, value in options.items() if value)
+
+
+def postprocess_svg(svg, options, _fontmap):
+    """Minify the SVG image and embed the font into it (as configured)."""
+    # prefix of class names and font names; they should be unique in the HTML
+    prefix = 'seqdiag-%s-' % sha1(svg.encode('utf-8')).hexdigest()[:8]
+    if options.get('embed_font'):
+        try:
+            svg = embed_font(svg, _fontmap, prefix)
         except ImportError:
-            raise ImportError('Could not output PDF format. Install reportlab.')
+            logger.warning('seqdiag: Could not embed fonts to SVG images. Install fonttools.')
+        except Exception as exc:
+            logger.warning('seqdiag: Could not embed fonts to SVG images: %s', exc)
+
+    if options.get('minify'):
+        svg = minify_svg(svg, prefix)
+
+    return svg
+
+
+def embed_font(svg, _fontmap, prefix):
+    """Embed a subset of the default font (in WOFF) to the SVG image."""
+    from fontTools import subset
+    from fontTools.ttLib import TTFont
+
+    font = _fontmap.find()
+    if font.path is None:
+        return svg
+
+    characters = set(''.join(html.unescape(text) for text in svg_text.findall(svg)))
+    if not characters:
+        return svg
+
+    path, index = parse_fontpath(font.path)
+    ttfont = TTFont(path, fontNumber=index or 0)
+    options = subset.Options()
+    options.drop_tables += ['FFTM']  # not used by browsers
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(text=''.join(sorted(characters)))
+    subsetter.subset(ttfont)
+
+    data = BytesIO()
+    ttfont.flavor = 'woff'
+    ttfont.save(data)
+
+    family = prefix + 'font'
+    fontface = ('<style>@font-face{font-family:%s;src:url(data:font/woff;base64,%s)}</style>' %
+                (family, base64.b64encode(data.getvalue()).decode('ascii')))
+    svg = svg.replace('font-family="%s"' % font.generic_family,
+                      'font-family="%s,%s"' % (family, font.generic_family))
+
+    index = svg.index('>', svg.index('<svg')) + 1
+    return svg[:index] + fontface + svg[index:]
+
+
+def minify_svg(svg, prefix):
+    """Minify the SVG image.
+
+    This removes whitespaces between tags, rounds numbers, shortens colors and
+    moves repeated presentation attributes to shared <style>.
+    """
+    def shorten(value):
+        value = svg_number.sub(lambda m: ('%.3f' % float(m.group(0))).rstrip('0').rstrip('.'), value)
+
+        def hexcolor(matched):
+            color = ''.join('%02x' % int(n) for n in matched.groups())
+            if color[0::2] == color[1::2]:
+                color = color[0::2]
+            return '#' + color
+
+        return svg_color.sub(hexcolor, value)
+
+    shortened = SVG_GEOMETRY_ATTRIBUTES + SVG_STYLE_ATTRIBUTES
+
+    def split(attributes):
+        attributes = [(name, shorten(value) if name in shortened else value)
+                      for name, value in svg_attribute.findall(attributes)
+                      if name not in ('inkspace:collect', 'xmlns:inkspace')]
+        styles = tuple(attr for attr in attributes if attr[0] in SVG_STYLE_ATTRIBUTES)
+        others = [attr for attr in attributes if attr[0] not in SVG_STYLE_ATTRIBUTES]
+        return others, styles
+
+    svg = re.sub(r'>\s+<', '><', svg.strip()).replace('<desc />', '')
+    counts = Counter(split(attributes)[1] for _, attributes, _ in svg_tag.findall(svg))
+    classes = {}
+
+    def rewrite(matched):
+        name, attributes, empty = matched.groups()
+        attributes, styles = split(attributes)
+        if name != 'svg' and styles and counts[styles] > 1:
+            if styles not in classes:
+                classes[styles] = '%s%d' % (prefix, len(classes))
+            attributes.append(('class', classes[styles]))
+        else:
+            attributes.extend(styles)
+
+        return '<%s%s%s>' % (name, ''.join(' %s="%s"' % attr for attr in attributes), empty)
+
+    svg = svg_tag.sub(rewrite, svg)
+    if classes:
+        rules = []
+        for styles, classname in classes.items():
+            properties = []
+            for name, value in styles:
+                if name == 'style':
+                    properties.append(value)
+                elif name in ('font-size', 'stroke-width') and re.match(r'^[\d.]+$', value):
+                    properties.append('%s:%spx' % (name, value))  # CSS requires units
+                else:
+                    properties.append('%s:%s' % (name, value))
+            rules.append('.%s{%s}' % (classname, ';'.join(properties)))
+
+        index = svg.index('>', svg.index('<svg')) + 1
+        svg = svg[:index] + '<style>%s</style>' % ''.join(rules) + svg[index:]
+
+    return svg
+
+
+def save_image(image, srcset=False):
+    if srcset:
+        # save in double resolution; it is scaled down by postprocess_png()
+        pagesize = image.pagesize()
+        image.save(Size(pagesize.width * 2, pagesize.height * 2))
+    else:
+        image.save()
 
-    return image_format
+
+def get_hidpi_filename(filename):
+    """Get a filename of the high resolution variant of the image (<name>@2x.<ext>)."""
+    basename, ext = os.path.splitext(filename)
+    return basename + '@2x' + ext
+
+
+def postprocess_png(tmpname, filename, pagesize, options):
+    """Optimize the PNG image and make its high resolution variant (as configured)."""
+    from PIL import Image
+
+    image = Image.open(tmpname)
+    image.load()
+    if options.get('srcset'):
+        # the image has been rendered in double resolution
+        hidpi_filename = get_hidpi_filename(filename)
+        with atomic_file(hidpi_filename) as hidpi_tmpname:
+            save_png(image, hidpi_tmpname, options.get('optimize'))
+
+        image = image.resize(tuple(pagesize), Image.LANCZOS)
+
+    save_png(image, tmpname, options.get('optimize'))
+
+
+def save_png(image, filename, optimize=False):
+    if optimize:
+        # reduce colors to 256 (with alpha channel) by fast octree method
+        image = image.quantize(256, method=2)
+        image.save(filename, 'PNG', optimize=True)
+    else:
+        image.save(filename, 'PNG')
+
+
+def render_image(job, _fontmap=None):
+    """Render a diagram to job.filename; this mainly runs in the worker processes."""
+    # artefacts in other formats (seqdiag_render_formats) share the parsed diagram
+    for extra in job.extras:
+        try:
+            render_image(extra, _fontmap)
+        except Exception as exc:
+            # error will be reported by the builder using the format
+            logger.debug('seqdiag: failed to render %s: %s', os.path.basename(extra.filename), exc)
+
+    ensuredir(os.path.dirname(job.filename))  # extras are rendered into the cache directory
+    with claim_image(job.filename) as tmpname:
+        if tmpname is None:
+            return  # already rendered by another process
+
+        stopwatch = Stopwatch()
+        rendered = job.server and request_render(job)
+        if rendered:
+            data, metadata = rendered
+            with open(tmpname, 'wb') as f:
+                f.write(data)
+            stopwatch.lap('draw')
+        else:
+            with application():
+                peak_rss = get_peak_rss()
+                srcset = job.output_options.get('srcset')
+                node = seqdiag_node(code=job.code, options=job.options)
+                image, downsampled = create_bounded_drawer(node, job.image_format, tmpname,
+                                                           _fontmap or fontmap, job.antialias or srcset,
+                                                           job.max_pixels, stopwatch,
+                                                           transparency=job.transparency)
+                metadata = get_image_metadata(image)
+                if downsampled:
+                    logger.info('seqdiag: %s is drawn in single resolution to fit in seqdiag_max_pixels',
+                                os.path.basename(job.filename))
+                    metadata['downsampled'] = True
+                    srcset = False
+                if job.references:
+                    substitute_references(image, job.references)
+
+                image.draw()
+                stopwatch.lap('draw')
+                canvas = get_canvas_usage(image)
+                save_image(image, srcset)
+                stopwatch.lap('save')
+                report_memory_usage(job.filename, canvas, peak_rss)
+
+        output_options = job.output_options
+        if metadata.get('downsampled'):
+            output_options = dict(output_options, srcset=False)
+
+        if job.image_format == 'SVG':
+            with open(tmpname, encoding='utf-8') as f:
+                svg = add_link_targets(f.read())
+            if job.output_options:
+                svg = postprocess_svg(svg, job.output_options, _fontmap or fontmap)
+            with open(tmpname, 'w', encoding='utf-8') as f:
+                f.write(svg)
+        elif job.image_format == 'PNG' and output_options:
+            postprocess_png(tmpname, job.filename, metadata['pagesize'], output_options)
+            stopwatch.lap('save')
+        if job.sidecar:
+            save_image_metadata(job.filename, metadata)
+        record_profile(job.profile, job.docname, job.line, job.filename, stopwatch,
+                       os.path.getsize(tmpname))
+
+
+def is_claimed(lockname):
+    """Check the lock file is held by a living process."""
+    try:
+        with open(lockname, encoding='utf-8') as f:
+            pid = int(f.read() or 0)
+        stat = os.stat(lockname)
+    except (OSError, ValueError):
+        return False
+
+    if time.time() - stat.st_mtime >= LOCK_EXPIRES:
+        return False  # the owner has hung, or its pid has been reused
+    elif os.name == 'posix' and pid:
+        # a process never waits for its own lock; it was left by a killed process with the same pid
+        return pid != os.getpid() and is_process_alive(pid)
+    else:
+        return True
+
+
+def is_process_alive(pid):
+    """Check the process is alive; this always returns True on non-posix platforms."""
+    if os.name != 'posix':
+        return True
+
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+
+
+@contextmanager
+def atomic_file(filename):
+    """Yield a temporary filename to write; it is renamed to *filename* atomically on success.
+
+    The temporary file is named <filename>.<pid>.tmp<ext> (the extension is
+    kept for the image libraries guessing the format from it).
+    """
+    tmpname = '%s.%d.tmp%s' % (filename, os.getpid(), os.path.splitext(filename)[1])
+    try:
+        yield tmpname
+        os.replace(tmpname, filename)
+    finally:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+
+
+def atomic_write(filename, data):
+    """Write *data* (str or bytes) to *filename* atomically."""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+
+    with atomic_file(filename) as tmpname:
+        with open(tmpname, 'wb') as f:
+            f.write(data)
+
+
+def atomic_copy(src, dest):
+    """Copy *src* to *dest* atomically; the file is hard-linked if possible."""
+    with atomic_file(dest) as tmpname:
+        try:
+            os.link(src, tmpname)
+        except OSError:
+            shutil.copyfile(src, tmpname)
+
+
+def remove_stale_files(filename):
+    """Remove the lock and temporary files of the image left by killed processes."""
+    dirname, basename = os.path.split(filename)
+    stem = os.path.splitext(basename)[0]
+    tmpfile = re.compile(r'^%s(?:@2x)?\.\w+(?:\.json)?\.(\d+)\.tmp(?:\.\w+)?$' % re.escape(stem))  # see atomic_file()
+    try:
+        lockname = filename + '.lock'
+        if os.path.exists(lockname) and not is_claimed(lockname):
+            os.remove(lockname)
+
+        for name in os.listdir(dirname):
+            matched = tmpfile.match(name)
+            if matched and not is_process_alive(int(matched.group(1))):
+                os.remove(os.path.join(dirname, name))
+    except OSError as exc:
+        logger.debug('seqdiag: could not remove stale files of %s: %s', filename, exc)
+
+
+@contextmanager
+def claim_image(filename):
+    """Claim rendering of the image across processes.
+
+    This yields a temporary filename to render the image into; it is renamed
+    to *filename* atomically on exit.  If the image has been rendered by
+    another process, this waits for it and yields None.
+    """
+    lockname = filename + '.lock'
+    while True:
+        if os.path.isfile(filename):
+            yield None
+            return
+
+        try:
+            fd = os.open(lockname, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.write(fd, str(os.getpid()).encode())
+            os.close(fd)
+            break
+        except FileExistsError:
+            if is_claimed(lockname):
+                time.sleep(0.05)  # another process is rendering the image
+            else:
+                try:
+                    os.remove(lockname)  # stale lock
+                except OSError:
+                    pass
+
+    if os.path.isfile(filename):  # rendered by another process just before locking
+        os.remove(lockname)
+        yield None
+        return
+
+    try:
+        with atomic_file(filename) as tmpname:
+            yield tmpname
+    finally:
+        try:
+            os.remove(lockname)
+        except FileNotFoundError:
+            pass  # broken as stale by another process
+
+
+def get_render_pool(builder):
+    global render_pool
+
+    # a pool inherited from the parent process (via fork) is not usable
+    if render_pool is None or render_pool[0] != os.getpid():
+        from multiprocessing import Pool
+
+        # a single worker isolates rendering from the build process for seqdiag_render_timeout
+        pool = Pool(builder.config.seqdiag_render_workers or 1, init_render_worker,
+                    (get_fontmap(builder), diagram_cachedir))
+        atexit.register(pool.terminate)
+        render_pool = (os.getpid(), pool)
+
+    return render_pool[1]
+
+
+def terminate_render_pool():
+    """Terminate the render pool to kill stalled workers; a new pool is created on next use."""
+    global render_pool
+
+    if render_pool and render_pool[0] == os.getpid():
+        render_pool[1].terminate()
+    render_pool = None
+
+
+def wait_render_result(builder, result, filename=None):
+    """Wait for the result of the render pool within seqdiag_render_timeout.
+
+    On timeout, the pool is terminated to kill the worker rendering the image.
+    """
+    from multiprocessing import TimeoutError
+
+    timeout = builder.config.seqdiag_render_timeout
+    try:
+        return result.get(timeout or None)
+    except TimeoutError:
+        terminate_render_pool()
+        if filename:
+            remove_stale_files(filename)
+            timed_out_images.add(filename)
+        disable_render_server(builder)
+        raise RenderTimeout('rendering timed out after %s seconds' % timeout)
+    except RenderTimeout:  # timed out on the render server
+        disable_render_server(builder)
+        raise
+
+
+def disable_render_server(builder):
+    """Render following diagrams locally; the render server may be still busy with the timed out one."""
+    server = get_render_server(builder)
+    if server:
+        unavailable_servers.add(server.address)
+
+
+def render_job(builder, job):
+    """Render the image of the job; it runs in the render pool if seqdiag_render_timeout is set."""
+    if builder.config.seqdiag_render_timeout:
+        if job.filename in timed_out_images:
+            raise RenderTimeout('rendering timed out after %s seconds' % builder.config.seqdiag_render_timeout)
+
+        result = get_render_pool(builder).apply_async(render_image, (job,))
+        wait_render_result(builder, result, job.filename)
+    else:
+        render_image(job, get_fontmap(builder))
+
+
+def render_in_pool(builder, jobs):
+    """Render the jobs in the render pool; yields (filename, exception or None) for each job.
+
+    If a job exceeds seqdiag_render_timeout, the pool is terminated with other
+    running jobs; unfinished ones are submitted to a new pool again.
+    """
+    pool = get_render_pool(builder)
+    results = {filename: pool.apply_async(render_image, (job,)) for filename, job in jobs.items()}
+    filenames = list(jobs)
+    for i, filename in enumerate(filenames):
+        try:
+            wait_render_result(builder, results[filename], filename)
+            yield filename, None
+        except RenderTimeout as exc:
+            pool = get_render_pool(builder)
+            for name in filenames[i + 1:]:
+                if not results[name].ready():
+                    remove_stale_files(name)
+                    results[name] = pool.apply_async(render_image, (jobs[name],))
+
+            yield filename, exc
+        except Exception as exc:
+            yield filename, exc
+
+
+def render_serial(builder, jobs):
+    """Render the jobs in this process; yields (filename, exception or None) for each job."""
+    for filename, job in jobs.items():
+        try:
+            render_image(job, get_fontmap(builder))
+            yield filename, None
+        except Exception as exc:
+            yield filename, exc
+
+
+def get_render_server(builder):
+    """Get the render server configured by seqdiag_render_server (or None if disabled)."""
+    config = builder.config
+    if not config.seqdiag_render_server or os.name != 'posix':
+        return None
+
+    if config.seqdiag_render_server is True:
+        from sphinxcontrib.seqdiag_server import get_runtime_dir
+
+        # the versions of renderers are also mixed into the address
+        filename = 'seqdiag-%s.sock' % get_cache_key()[:12]
+        address = os.path.join(get_runtime_dir(), filename)
+    else:
+        address = os.path.join(builder.confdir, config.seqdiag_render_server)
+
+    if address in unavailable_servers:
+        return None
+
+    # the server runs in another directory; fonts are given as absolute paths
+    fontpath = config.seqdiag_fontpath
+    if isinstance(fontpath, str):
+        fontpath = [fontpath]
+    fontpath = [os.path.abspath(path) for path in fontpath or []]
+    fontmapfile = config.seqdiag_fontmap and os.path.abspath(config.seqdiag_fontmap)
+
+    return RenderServer(address, fontpath, fontmapfile, config.seqdiag_render_timeout)
+
+
+def request_render(job, inline=False):
+    """Render a diagram on the render server; returns (data, metadata).
+
+    This returns None if the server is not available.  If *inline* is given,
+    the diagram is rendered as SVG for embedding to HTML.
+    """
+    import socket
+    from sphinxcontrib.seqdiag_server import REQUEST_TIMEOUT, send_request
+
+    request = dict(command='render', version=get_cache_key(), code=job.code, options=job.options,
+                   format=job.image_format, antialias=job.antialias, transparency=job.transparency,
+                   references=job.references, fontpath=job.server.fontpath,
+                   fontmap=job.server.fontmap, output_options=job.output_options,
+                   max_pixels=job.max_pixels, inline=inline, timeout=job.server.timeout)
+    try:
+        response = send_request(job.server.address, request, start=True,
+                                timeout=job.server.timeout or REQUEST_TIMEOUT)
+    except socket.timeout:
+        # the server may be still busy with the diagram; others are rendered locally
+        unavailable_servers.add(job.server.address)
+        raise RenderTimeout('rendering timed out after %s seconds' % (job.server.timeout or REQUEST_TIMEOUT))
+    except OSError as exc:
+        logger.warning('seqdiag: render server %s is not available (%s); render diagrams locally',
+                       job.server.address, exc)
+        unavailable_servers.add(job.server.address)
+        return None
+
+    if response.get('too_large'):
+        raise ImageTooLarge(response['error'])
+    elif 'error' in response:
+        raise RuntimeError(response['error'])
+
+    return base64.b64decode(response['data']), response['metadata']
+
+
+class Stopwatch(object):
+    """Measure elapsed time of each rendering phase (for seqdiag_profile)."""
+
+    def __init__(self):
+        self.laps = {}
+        self.started = time.time()
+
+    def lap(self, name):
+        now = time.time()
+        self.laps[name] = self.laps.get(name, 0) + now - self.started
+        self.started = now
+
+
+def get_profile_dir(builder):
+    if builder.config.seqdiag_profile:
+        return os.path.join(builder.doctreedir, 'seqdiag-profile')
+    else:
+        return None
+
+
+def record_profile(profiledir, docname, line, filename, stopwatch, size=None):
+    """Record timings of a diagram; each process writes records to its own file."""
+    if profiledir is None:
+        return
+
+    if size is None:
+        size = os.path.getsize(filename)
+
+    record = dict(docname=docname, line=line, image=os.path.basename(filename),
+                  parse=stopwatch.laps.get('parse', 0), layout=stopwatch.laps.get('layout', 0),
+                  draw=stopwatch.laps.get('draw', 0), save=stopwatch.laps.get('save', 0),
+                  total=sum(stopwatch.laps.values()), size=size)
+    try:
+        ensuredir(profiledir)
+        with open(os.path.join(profiledir, '%d.jsonl' % os.getpid()), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+    except OSError as exc:
+        logger.debug('seqdiag: could not record profile: %s', exc)
+
+
+def write_profile_report(builder):
+    """Aggregate the records of all processes and write reports (sorted by total time)."""
+    profiledir = get_profile_dir(builder)
+    if profiledir is None or not os.path.isdir(profiledir):
+        return
+
+    records = []
+    for filename in os.listdir(profiledir):
+        with open(os.path.join(profiledir, filename), encoding='utf-8') as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+
+    records.sort(key=lambda r: r['total'], reverse=True)
+    fields = ['docname', 'line', 'image', 'parse', 'layout', 'draw', 'save', 'total', 'size']
+    with open(os.path.join(builder.outdir, 'seqdiag-profile.json'), 'w', encoding='utf-8') as f:
+        json.dump(records, f, indent=2)
+    with open(os.path.join(builder.outdir, 'seqdiag-profile.csv'), 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fields)
+        writer.writeheader()
+        writer.writerows(records)
+
+    logger.info('seqdiag: profile of %d diagrams is written to seqdiag-profile.json', len(records))
 
 
 def on_builder_inited(self):
+    global diagram_cachedir
+
     # show deprecated message
     if self.builder.config.seqdiag_tex_image_format:
         logger.warning('seqdiag_tex_image_format is deprecated. Use seqdiag_latex_image_format.')
 
-    # initialize fontmap
-    global fontmap
+    if self.builder.config.seqdiag_render_server and os.name != 'posix':
+        logger.warning('seqdiag_render_server is not supported on this platform.')
 
-    try:
-        fontmappath = self.builder.config.seqdiag_fontmap
-        fontmap = FontMap(fontmappath)
-    except Exception:
-        fontmap = FontMap(None)
+    for name, capability in (self.builder.config.seqdiag_builder_capabilities or {}).items():
+        if capability not in ('image', 'alt', 'none'):
+            logger.warning('seqdiag_builder_capabilities: unknown capability for %s: %s', name, capability)
 
-    try:
-        fontpath = self.builder.config.seqdiag_fontpath
-        if isinstance(fontpath, str):
-            fontpath = [fontpath]
+    if self.builder.config.seqdiag_html_image_loading not in (None, 'lazy', 'eager'):
+        logger.warning('seqdiag_html_image_loading: unknown value: %s',
+                       self.builder.config.seqdiag_html_image_loading)
+    if self.builder.config.seqdiag_html_image_decoding not in (None, 'async', 'sync', 'auto'):
+        logger.warning('seqdiag_html_image_decoding: unknown value: %s',
+                       self.builder.config.seqdiag_html_image_decoding)
 
-        if fontpath:
-            config = namedtuple('Config', 'font')(fontpath)
-            fontpath = detectfont(config)
-            fontmap.set_default_font(fontpath)
-    except Exception:
-        pass
+    for image_format in get_render_formats(self.builder):
+        if image_format not in ('PNG', 'PDF', 'SVG'):
+            logger.warning('seqdiag_render_formats: unknown format: %s', image_format)
+
+    resolved_references.clear()
+    undefined_labels.clear()
+    unavailable_servers.clear()
+    timed_out_images.clear()
+    capabilities.clear()
+    terminate_render_pool()  # left by the previous build (if not finished)
+    diagram_cachedir = get_parsed_cachedir(self.builder)
+
+    # clear records of the previous build
+    profiledir = get_profile_dir(self.builder)
+    if profiledir and os.path.isdir(profiledir):
+        shutil.rmtree(profiledir)
 
 
 def on_doctree_resolved(self, doctree, docname):
+    capability = get_builder_capability(self.builder)
+    if capability != 'image':
+        replace_diagrams(doctree, capability)
+        return
+
     if self.builder.format in ('html', 'slides'):
         return
 
@@ -288,14 +1878,22 @@ def on_doctree_resolved(self, doctree, docname):
 
         return
 
+    if self.builder.config.seqdiag_render_workers > 0:
+        render_parallel(self.builder, doctree, docname, image_format)
+        return
+
     for node in doctree.traverse(seqdiag_node):
         try:
-            with Application():
-                relfn = node.get_relpath(image_format, self.builder)
-                image = node.to_drawer(image_format, self.builder)
-                if not os.path.isfile(image.filename):
-                    image.draw()
-                    image.save()
+            with application():
+                try:
+                    relfn = render_node_image(self.builder, node, image_format, docname)
+                except ImageTooLarge as exc:
+                    fallback = get_fallback_format(self.builder, image_format)
+                    if fallback is None:
+                        raise
+
+                    logger.info('seqdiag: %s; rendered as %s instead', exc, fallback)
+                    relfn = render_node_image(self.builder, node, fallback, docname)
 
                 image = nodes.image(uri=relfn, candidates={'*': relfn}, **node['options'])
                 node.parent.replace(node, image)
@@ -307,6 +1905,240 @@ def on_doctree_resolved(self, doctree, docname):
             node.parent.remove(node)
 
 
+def get_builder_capability(builder):
+    """Get how diagrams are shown on the builder: 'image', 'alt' or 'none'."""
+    table = dict(BUILDER_CAPABILITIES, **(builder.config.seqdiag_builder_capabilities or {}))
+    return table.get(builder.name, 'image')
+
+
+def replace_diagrams(doctree, capability):
+    """Replace diagrams by cheap nodes for the builders which can not display images."""
+    for node in doctree.traverse(seqdiag_node):
+        if capability == 'alt' and node['options'].get('alt'):
+            node.parent.replace(node, nodes.paragraph(text=node['options']['alt']))
+        elif capability == 'alt':
+            code = node.get('rawcode', node['code'])
+            node.parent.replace(node, nodes.literal_block(code, code, language='none'))
+        else:
+            node.parent.remove(node)
+
+
+def render_node_image(builder, node, image_format, docname):
+    """Render the diagram unless rendered yet; returns the relative path of the image."""
+    filename = node.get_abspath(image_format, builder)
+    if not is_rendered(builder, filename):
+        job = node.to_job(image_format, builder, filename, docname)
+        render_job(builder, job)
+        store_to_cache(builder, job.filename)
+
+    return node.get_relpath(image_format, builder)
+
+
+def get_fallback_format(builder, image_format):
+    """Get a vector format for the diagrams exceeding seqdiag_max_pixels (if available)."""
+    if builder.format == 'latex' and image_format == 'PNG' and is_format_available('PDF'):
+        return 'PDF'
+    else:
+        return None
+
+
+def render_parallel(builder, doctree, docname, image_format):
+    # collect all diagrams in the document at first
+    pending = []
+    jobs = {}
+    for node in doctree.traverse(seqdiag_node):
+        try:
+            relfn = node.get_relpath(image_format, builder)
+            filename = node.get_abspath(image_format, builder)
+            if filename not in jobs and not is_rendered(builder, filename):
+                jobs[filename] = node.to_job(image_format, builder, filename, docname)
+
+            pending.append((node, relfn, filename))
+        except Exception as exc:
+            if builder.config.seqdiag_debug:
+                traceback.print_exc()
+
+            logger.warning('dot code %r: %s', node['code'], exc)
+            node.parent.remove(node)
+
+    # render them in parallel
+    errors = {}
+    for filename, exc in render_in_pool(builder, jobs):
+        if exc is None:
+            store_to_cache(builder, jobs[filename].filename)
+        else:
+            if builder.config.seqdiag_debug:
+                traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+            errors[filename] = exc
+
+    # then replace them by rendered images
+    fallback = get_fallback_format(builder, image_format)
+    for node, relfn, filename in pending:
+        if isinstance(errors.get(filename), ImageTooLarge) and fallback:
+            try:
+                with application():
+                    relfn = render_node_image(builder, node, fallback, docname)
+                logger.info('seqdiag: %s; rendered as %s instead', errors[filename], fallback)
+            except Exception as exc:
+                logger.warning('dot code %r: %s', node['code'], exc)
+                node.parent.remove(node)
+                continue
+        elif filename in errors:
+            logger.warning('dot code %r: %s', node['code'], errors[filename])
+            node.parent.remove(node)
+            continue
+
+        image = nodes.image(uri=relfn, candidates={'*': relfn}, **node['options'])
+        node.parent.replace(node, image)
+
+
+def on_env_updated(self, env):
+    if not self.builder.config.seqdiag_prerender:
+        return
+    elif get_builder_capability(self.builder) != 'image':
+        return
+
+    try:
+        image_format = get_image_format_for(self.builder)
+    except Exception:
+        return  # error will be reported on writing phase
+
+    svg_file = self.builder.format in ('html', 'slides') and image_format == 'SVG'
+    if svg_file and self.builder.config.seqdiag_html_svg_mode == 'inline':
+        return  # SVG images are embedded to HTML directly
+    elif image_format in PICTURE_FORMATS:
+        image_format = 'PNG'  # they are converted from PNG images on writing
+
+    # collect all diagrams in the project
+    jobs = {}
+    for docname in sorted(env.seqdiag_diagrams):
+        for code, options in env.seqdiag_diagrams[docname]:
+            try:
+                node = seqdiag_node(code=code, options=options)
+                if svg_file:
+                    job, _ = get_svg_file_job(self.builder, node, docname)
+                else:
+                    filename = node.get_abspath(image_format, self.builder)
+                    job = node.to_job(image_format, self.builder, filename, docname)
+                if job.filename not in jobs and not is_rendered(self.builder, job.filename):
+                    jobs[job.filename] = job
+            except Exception as exc:
+                # error will be reported on writing phase
+                logger.debug('seqdiag: could not prerender %r: %s', code, exc)
+
+    if not jobs:
+        return
+
+    if self.builder.config.seqdiag_render_workers > 0 or self.builder.config.seqdiag_render_timeout:
+        results = render_in_pool(self.builder, jobs)
+    else:
+        results = render_serial(self.builder, jobs)
+
+    for filename, exc in status_iterator(results, 'rendering seqdiag images... ', 'darkgreen',
+                                         len(jobs), self.verbosity,
+                                         stringify_func=lambda result: os.path.basename(result[0])):
+        if exc is None:
+            store_to_cache(self.builder, jobs[filename].filename)
+        else:
+            # error will be reported again on writing phase
+            logger.debug('seqdiag: failed to render %s: %s', filename, exc)
+
+
+def on_doctree_read(self, doctree):
+    diagrams = [(node['code'], node['options']) for node in doctree.traverse(seqdiag_node)]
+    if diagrams:
+        self.env.seqdiag_diagrams[self.env.docname] = diagrams
+
+
+def on_env_before_read_docs(self, env, docnames):
+    if not hasattr(env, 'seqdiag_diagrams'):
+        env.seqdiag_diagrams = {}
+
+
+def on_env_purge_doc(self, env, docname):
+    if hasattr(env, 'seqdiag_diagrams'):
+        env.seqdiag_diagrams.pop(docname, None)
+
+
+def on_env_merge_info(self, env, docnames, other):
+    for docname in docnames:
+        if docname in other.seqdiag_diagrams:
+            env.seqdiag_diagrams[docname] = other.seqdiag_diagrams[docname]
+
+
+def collect_garbage(builder):
+    """Remove images which are no longer referenced from any documents."""
+    if get_builder_capability(builder) != 'image':
+        return  # no images are rendered
+
+    try:
+        image_format = get_image_format_for(builder)
+    except Exception:
+        return
+
+    svg_file = builder.format in ('html', 'slides') and image_format == 'SVG'
+    if image_format in PICTURE_FORMATS:
+        converted, image_format = image_format, 'PNG'
+    else:
+        converted = None
+    fallback = get_fallback_format(builder, image_format)
+
+    referenced = set()
+    for diagrams in getattr(builder.env, 'seqdiag_diagrams', {}).values():
+        for code, options in diagrams:
+            node = seqdiag_node(code=code, options=options)
+            if svg_file:
+                if builder.config.seqdiag_html_svg_mode != 'inline':
+                    job, _ = get_svg_file_job(builder, node, extras=False)
+                    referenced.add(os.path.basename(job.filename))
+                    if builder.config.seqdiag_html_svgz:
+                        referenced.add(os.path.basename(job.filename) + 'z')
+                    if 'PNG' in get_render_formats(builder):  # fallback of the SVG image
+                        filename = posixpath.basename(node.get_relpath('PNG', builder))
+                        referenced.add(filename)
+                        if get_output_options(builder, 'PNG').get('srcset'):
+                            referenced.add(get_hidpi_filename(filename))
+                continue
+
+            filename = posixpath.basename(node.get_relpath(image_format, builder))
+            filenames = [filename]
+            if get_output_options(builder, image_format).get('srcset'):
+                filenames.append(get_hidpi_filename(filename))
+            if converted:
+                filenames.extend([get_variant_filename(name, converted) for name in filenames])
+            if fallback:  # for diagrams exceeding seqdiag_max_pixels
+                filenames.append(posixpath.basename(node.get_relpath(fallback, builder)))
+            referenced.update(filenames)
+
+    outputdir = get_outputdir(builder)
+    if not os.path.isdir(outputdir):
+        return
+
+    for filename in os.listdir(outputdir):
+        matched = image_filename.match(filename)
+        if matched and matched.group(1) not in referenced:
+            try:
+                os.remove(os.path.join(outputdir, filename))
+            except OSError as exc:
+                logger.debug('seqdiag: could not remove %s: %s', filename, exc)
+
+
+def on_build_finished(self, exc):
+    global render_pool
+
+    if render_pool and render_pool[0] == os.getpid():
+        render_pool[1].close()
+        render_pool[1].join()
+    render_pool = None
+
+    if exc is None:
+        collect_garbage(self.builder)
+        write_profile_report(self.builder)
+
+    evict_cache(self)
+
+
 def setup(app):
     app.add_node(seqdiag_node,
                  html=(html_visit_seqdiag, html_depart_seqdiag))
@@ -317,13 +2149,38 @@ def setup(app):
     app.add_config_value('seqdiag_transparency', True, 'html')
     app.add_config_value('seqdiag_debug', False, 'html')
     app.add_config_value('seqdiag_html_image_format', 'PNG', 'html')
+    app.add_config_value('seqdiag_html_svg_mode', 'inline', 'html')
+    app.add_config_value('seqdiag_html_svgz', False, 'html')
+    app.add_config_value('seqdiag_html_png_srcset', False, 'html')
+    app.add_config_value('seqdiag_html_image_loading', None, 'html')  # 'lazy' or 'eager'
+    app.add_config_value('seqdiag_html_image_decoding', None, 'html')  # 'async', 'sync' or 'auto'
+    app.add_config_value('seqdiag_png_optimize', False, 'html')
+    app.add_config_value('seqdiag_svg_minify', False, 'html')
+    app.add_config_value('seqdiag_svg_embed_font', False, 'html')
     app.add_config_value('seqdiag_tex_image_format', None, 'html')  # backward compatibility for 0.6.1
     app.add_config_value('seqdiag_latex_image_format', 'PNG', 'html')
+    app.add_config_value('seqdiag_render_workers', 0, 'html')
+    app.add_config_value('seqdiag_prerender', False, 'html')
+    app.add_config_value('seqdiag_cache_dir', None, 'html')
+    app.add_config_value('seqdiag_cache_size', 256 * 1024 * 1024, 'html')
+    app.add_config_value('seqdiag_profile', False, 'html')
+    app.add_config_value('seqdiag_render_server', None, 'html')
+    app.add_config_value('seqdiag_max_pixels', 0, 'html')  # 0: unlimited
+    app.add_config_value('seqdiag_render_timeout', 0, 'html')  # 0: no timeout
+    app.add_config_value('seqdiag_render_formats', [], 'html')
+    app.add_config_value('seqdiag_builder_capabilities', {}, 'html')
     app.connect("builder-inited", on_builder_inited)
+    app.connect("env-before-read-docs", on_env_before_read_docs)
+    app.connect("env-purge-doc", on_env_purge_doc)
+    app.connect("env-merge-info", on_env_merge_info)
+    app.connect("doctree-read", on_doctree_read)
+    app.connect("env-updated", on_env_updated)
     app.connect("doctree-resolved", on_doctree_resolved)
+    app.connect("build-finished", on_build_finished)
 
     return {
-        'version': pkg_resources.require('seqdiag')[0].version,
+        'version': seqdiag.__version__,
+        'env_version': 1,
         'parallel_read_safe': True,
         'parallel_write_safe': True,
     }
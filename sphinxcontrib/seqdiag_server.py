@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinxcontrib.seqdiag_server
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Render server for sphinxcontrib-seqdiag (seqdiag_render_server).
+
+    The server keeps fonts and renderers loaded between sphinx-build runs.  It
+    listens on a Unix domain socket which is accessible only from its owner.
+
+    Usage::
+
+        $ python -m sphinxcontrib.seqdiag_server /path/to/seqdiag.sock
+        $ python -m sphinxcontrib.seqdiag_server --stop /path/to/seqdiag.sock
+
+    :copyright: Copyright 2010 by Takeshi Komiya.
+    :license: BSDL.
+"""
+
+import os
+import sys
+import json
+import stat
+import time
+import base64
+import struct
+import tempfile
+from hashlib import sha1
+from contextlib import contextmanager
+from sphinxcontrib.seqdiag import (ImageTooLarge, RenderTimeout, application, create_bounded_drawer,
+                                   get_cache_key, get_image_metadata, load_fontmap, save_image,
+                                   seqdiag_node, substitute_references)
+
+# seconds to wait for the render server starting up
+SERVER_STARTUP_TIMEOUT = 10
+
+# seconds to wait for the response of the render server
+REQUEST_TIMEOUT = 600
+
+
+def get_runtime_dir():
+    """Get a private directory to put the sockets of render servers in."""
+    path = os.environ.get('XDG_RUNTIME_DIR')
+    if path and os.path.isdir(path):
+        return path
+    else:
+        return os.path.join(tempfile.gettempdir(), 'seqdiag-%d' % os.getuid())
+
+
+def ensure_private_dir(path):
+    """Create the directory accessible only from its owner unless exists."""
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError('%s is not a private directory' % path)
+
+
+def check_owner(address):
+    """Check that the socket and its directory are owned by (and writable only by) the current user.
+
+    Otherwise other users could replace the socket by their own one.
+    """
+    dirname = os.path.dirname(os.path.abspath(address))
+    for path in (address, dirname):
+        st = os.lstat(path)
+        if st.st_uid != os.getuid():
+            raise PermissionError('%s is owned by another user' % path)
+        elif path == dirname and st.st_mode & 0o022:
+            raise PermissionError('%s is writable by other users' % path)
+
+
+def check_peer(sock):
+    """Check that the peer of the socket runs as the current user (if the platform supports)."""
+    import socket
+
+    if hasattr(socket, 'SO_PEERCRED'):  # Linux
+        credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        _, uid, _ = struct.unpack('3i', credentials)
+        if uid != os.getuid():
+            raise PermissionError('render server runs as another user')
+
+
+def start_render_server(address):
+    """Start the render server as a daemon process."""
+    import subprocess
+
+    args = [sys.executable, '-m', 'sphinxcontrib.seqdiag_server', address]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+    return subprocess.Popen(args, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def send_request(address, request, start=False, timeout=REQUEST_TIMEOUT):
+    """Send a request to the render server; the server is started on demand if *start* is given."""
+    import socket
+
+    payload = (json.dumps(request) + '\n').encode('utf-8')
+    server = None
+    started = None
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            check_owner(address)
+            sock.connect(address)
+            check_peer(sock)
+            sock.sendall(payload)
+            sock.shutdown(socket.SHUT_WR)
+            with sock.makefile('rb') as f:
+                response = f.read()
+            if not response:
+                raise ConnectionError('render server closed the connection')
+
+            return json.loads(response.decode('utf-8'))
+        except (FileNotFoundError, ConnectionRefusedError):
+            if not start:
+                raise
+            elif server is None:
+                server = start_render_server(address)
+                started = time.time()
+            elif server.poll() is not None or time.time() - started > SERVER_STARTUP_TIMEOUT:
+                raise  # failed to start the server
+            time.sleep(0.05)
+        finally:
+            sock.close()
+
+
+def render_request(request):
+    """Render a diagram requested to the render server; returns (data, metadata)."""
+    node = seqdiag_node(code=request['code'], options=request['options'])
+    _fontmap = load_fontmap(request['fontpath'], request['fontmap'])
+    with application():
+        if request['inline']:
+            image = node.create_drawer('SVG', None, _fontmap, antialias=request['antialias'],
+                                       transparency=request['transparency'], nodoctype=True)
+            metadata = get_image_metadata(image)
+            substitute_references(image, request['references'])
+            image.draw()
+            size = image.pagesize().resize(**node['options'])
+            return image.save(size).encode('utf-8'), metadata
+
+        srcset = request['output_options'].get('srcset')
+        fd, tmpname = tempfile.mkstemp(suffix='.' + request['format'].lower())
+        os.close(fd)
+        try:
+            image, downsampled = create_bounded_drawer(node, request['format'], tmpname, _fontmap,
+                                                       request['antialias'] or srcset,
+                                                       request.get('max_pixels'),
+                                                       transparency=request['transparency'])
+            metadata = get_image_metadata(image)
+            if downsampled:
+                metadata['downsampled'] = True
+                srcset = False
+            substitute_references(image, request['references'])
+            image.draw()
+            save_image(image, srcset)
+            with open(tmpname, 'rb') as f:
+                return f.read(), metadata
+        finally:
+            os.remove(tmpname)
+
+
+@contextmanager
+def time_limit(seconds):
+    """Abort the rendering taking more than *seconds* (to get ready for following requests)."""
+    import signal
+
+    if not seconds or not hasattr(signal, 'setitimer'):
+        yield
+        return
+
+    def handler(signum, frame):
+        raise RenderTimeout('rendering timed out after %s seconds' % seconds)
+
+    previous = signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def handle_request(request):
+    """Handle a request to the render server; returns a response."""
+    command = request.get('command')
+    if command == 'ping':
+        return dict(version=get_cache_key())
+    elif command != 'render':
+        return dict(error='unknown command: %s' % command)
+    elif request.get('version') != get_cache_key():
+        return dict(error='render server runs another version of seqdiag')
+
+    try:
+        with time_limit(request.get('timeout')):
+            data, metadata = render_request(request)
+        return dict(data=base64.b64encode(data).decode('ascii'), metadata=metadata)
+    except ImageTooLarge as exc:
+        return dict(error='%s' % exc, too_large=True)
+    except Exception as exc:
+        return dict(error='%s' % exc)
+
+
+def serve(address, cache_size=64 * 1024 * 1024, idle_timeout=600):
+    """Run the render server on the Unix domain socket *address*.
+
+    The server keeps fonts and renderers loaded, and serves rendered images
+    from an in-memory LRU cache (up to *cache_size* bytes).  Requests are
+    processed one by one.  It exits after *idle_timeout* seconds of inactivity.
+    """
+    import socketserver
+    from collections import OrderedDict
+
+    dirname = os.path.dirname(os.path.abspath(address))
+    if not os.path.exists(dirname):
+        ensure_private_dir(dirname)
+    elif os.lstat(dirname).st_uid != os.getuid():
+        raise PermissionError('%s is owned by another user' % dirname)
+
+    if os.path.exists(address):
+        try:
+            send_request(address, dict(command='ping'))
+            return  # another server is running
+        except OSError:
+            os.remove(address)  # stale socket
+
+    cache = OrderedDict()  # {hash of request: response}
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            payload = self.rfile.readline()
+            key = sha1(payload).hexdigest()
+            if key in cache:
+                cache.move_to_end(key)
+                self.wfile.write(cache[key])
+                return
+
+            try:
+                request = json.loads(payload.decode('utf-8'))
+            except ValueError:
+                request = {}
+
+            if request.get('command') == 'shutdown':
+                self.server.stopped = True
+                response = dict(status='ok')
+            else:
+                response = handle_request(request)
+
+            cacheable = request.get('command') == 'render' and 'error' not in response
+            response = (json.dumps(response) + '\n').encode('utf-8')
+            if cacheable:
+                cache[key] = response
+                while sum(len(value) for value in cache.values()) > cache_size:
+                    cache.popitem(last=False)
+
+            self.wfile.write(response)
+
+    umask = os.umask(0o077)  # the socket is accessible only from its owner
+    try:
+        server = socketserver.UnixStreamServer(address, RequestHandler)
+    finally:
+        os.umask(umask)
+
+    def handle_timeout():
+        server.stopped = True
+
+    server.stopped = False
+    server.timeout = idle_timeout
+    server.handle_timeout = handle_timeout
+    try:
+        while not server.stopped:
+            server.handle_request()
+    finally:
+        server.server_close()
+        if os.path.exists(address):
+            os.remove(address)
+
+
+def main(args=sys.argv[1:]):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m sphinxcontrib.seqdiag_server',
+                                     description='render server for sphinxcontrib-seqdiag')
+    parser.add_argument('address', help='path of Unix domain socket')
+    parser.add_argument('--stop', action='store_true', help='stop the render server')
+    parser.add_argument('--cache-size', type=int, default=64 * 1024 * 1024,
+                        help='size of in-memory cache in bytes (default: 64MiB)')
+    parser.add_argument('--idle-timeout', type=int, default=600,
+                        help='exit after this seconds of inactivity (default: 600)')
+    options = parser.parse_args(args)
+
+    if options.stop:
+        send_request(options.address, dict(command='shutdown'))
+    else:
+        serve(options.address, options.cache_size, options.idle_timeout)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
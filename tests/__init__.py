@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+
+from sphinxcontrib.seqdiag import seqdiag_node
+
+import time
+
+create_drawer = seqdiag_node.create_drawer
+
+
+def slow_create_drawer(self, *args, **kwargs):
+    if 'slow' in self['code']:
+        time.sleep(60)  # simulate a pathological diagram
+
+    return create_drawer(self, *args, **kwargs)
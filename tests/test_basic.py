@@ -1,6 +1,16 @@
 # -*- coding: utf-8 -*-
 
+from mock import patch
 from sphinx_testing import with_app
+from sphinxcontrib.seqdiag import LOCK_EXPIRES, atomic_write, claim_image, remove_stale_files
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 
 
 @with_app(buildername='html', srcdir='tests/docs/basic/')
@@ -26,3 +36,141 @@ def test_build_epub(app, status, warning):
 @with_app(buildername='json', srcdir='tests/docs/basic/')
 def test_build_json(app, status, warning):
     app.builder.build_all()
+
+
+def test_rendering_stack_is_not_imported_on_setup():
+    script = ('import sys; import sphinxcontrib.seqdiag; '
+              'assert "seqdiag.drawer" not in sys.modules; '
+              'assert "PIL" not in sys.modules')
+    subprocess.check_call([sys.executable, '-c', script])
+
+
+def test_claim_image_breaks_stale_lock():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'seqdiag-test.png')
+        proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+        proc.wait()
+        with open(filename + '.lock', 'w') as f:
+            f.write(str(proc.pid))  # owned by a dead process
+
+        with claim_image(filename) as tmpname:
+            with open(tmpname, 'w') as f:
+                f.write('image')
+
+        assert open(filename).read() == 'image'
+        assert os.listdir(tmpdir) == ['seqdiag-test.png']
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_claim_image_breaks_lock_of_own_pid():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'seqdiag-test.png')
+        with open(filename + '.lock', 'w') as f:
+            f.write(str(os.getpid()))  # left by a killed process; its pid is reused
+
+        with claim_image(filename) as tmpname:
+            with open(tmpname, 'w') as f:
+                f.write('image')
+
+        assert open(filename).read() == 'image'
+        assert os.listdir(tmpdir) == ['seqdiag-test.png']
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_claim_image_breaks_expired_lock():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'seqdiag-test.png')
+        with open(filename + '.lock', 'w') as f:
+            f.write(str(os.getppid()))  # owned by a living but hung process
+        expired = time.time() - LOCK_EXPIRES - 1
+        os.utime(filename + '.lock', (expired, expired))
+
+        with claim_image(filename) as tmpname:
+            with open(tmpname, 'w') as f:
+                f.write('image')
+
+        assert open(filename).read() == 'image'
+        assert os.listdir(tmpdir) == ['seqdiag-test.png']
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_claim_image_waits_for_other_process():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'seqdiag-test.png')
+        with open(filename + '.lock', 'w') as f:
+            f.write(str(os.getppid()))  # owned by a living process
+
+        def render():
+            time.sleep(0.2)
+            with open(filename, 'w') as f:
+                f.write('image')
+            os.remove(filename + '.lock')
+
+        thread = threading.Thread(target=render)
+        thread.start()
+        with claim_image(filename) as tmpname:
+            assert tmpname is None
+        thread.join()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_claim_image_rendered_before_locking():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'seqdiag-test.png')
+        os_open = os.open
+
+        def render_and_open(path, *args):
+            # another process renders the image and releases the lock just before locking
+            with open(filename, 'w') as f:
+                f.write('image')
+            return os_open(path, *args)
+
+        with patch('os.open', side_effect=render_and_open):
+            with claim_image(filename) as tmpname:
+                assert tmpname is None
+
+        assert os.listdir(tmpdir) == ['seqdiag-test.png']
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_remove_stale_files():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'seqdiag-test.png')
+        proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+        proc.wait()
+        for name in ('seqdiag-test.png.%d.tmp.png', 'seqdiag-test@2x.png.%d.tmp.png',
+                     'seqdiag-test.png.json.%d.tmp.json'):
+            with open(os.path.join(tmpdir, name % proc.pid), 'w') as f:
+                f.write('')  # left by a dead process
+        living = os.path.join(tmpdir, 'seqdiag-test.png.%d.tmp.png' % os.getpid())
+        with open(living, 'w') as f:
+            f.write('')
+
+        remove_stale_files(filename)
+        assert os.listdir(tmpdir) == [os.path.basename(living)]
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_atomic_write():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'seqdiag-test.json')
+        atomic_write(filename, '{}')
+        atomic_write(filename, b'[]')
+
+        assert open(filename).read() == '[]'
+        assert os.listdir(tmpdir) == ['seqdiag-test.json']
+    finally:
+        shutil.rmtree(tmpdir)
@@ -45,9 +45,14 @@ class TestSphinxcontribSeqdiagErrors(unittest.TestCase):
         self.assertIn('UNKNOWN ERROR!', warning.getvalue())
 
     @with_app(srcdir='tests/docs/basic')
-    @patch("sphinxcontrib.seqdiag.seqdiag.drawer.DiagramDraw.draw")
+    @patch("seqdiag.drawer.DiagramDraw.draw")
     def test_font_settings_error(self, app, status, warning, draw):
         draw.side_effect = UnicodeEncodeError("", "", 0, 0, "")
         app.builder.build_all()
         self.assertIn('UnicodeEncodeError caught (check your font settings)',
                       warning.getvalue())
+
+    @with_app(srcdir='tests/docs/basic', confoverrides=dict(seqdiag_fontpath='/nonexistent/font.ttf'))
+    def test_font_not_found_error(self, app, status, warning):
+        app.builder.build_all()
+        self.assertIn("fontfile is not found: ['/nonexistent/font.ttf']", warning.getvalue())
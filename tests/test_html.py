@@ -1,13 +1,30 @@
 # -*- coding: utf-8 -*-
 
+from mock import patch
+from PIL import Image
 from sphinx_testing import with_app
-
+from seqdiag.parser import parse_string
+from sphinxcontrib.seqdiag import (evict_cache, fontmaps, get_cache_key, get_render_server, is_format_available,
+                                   parsed_diagrams, render_image, seqdiag_node, svg_images)
+from sphinxcontrib.seqdiag_server import handle_request, send_request
+from tests import slow_create_drawer
+
+import gzip
+import json
+import os
+import re
+import shutil
+import socket
 import sys
+import tempfile
+import time
 if sys.version_info < (2, 7):
     import unittest2 as unittest
 else:
     import unittest
 
+seqdiag_fontpath = '/usr/share/fonts/truetype/ipafont/ipagp.ttf'
+dejavu_fontpath = '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'
 with_png_app = with_app(srcdir='tests/docs/basic',
                         buildername='html',
                         write_docstring=True)
@@ -17,6 +34,14 @@ with_svg_app = with_app(srcdir='tests/docs/basic',
                         confoverrides={
                             'seqdiag_html_image_format': 'SVG',
                         })
+with_svg_file_app = with_app(srcdir='tests/docs/basic',
+                             buildername='html',
+                             write_docstring=True,
+                             confoverrides={
+                                 'seqdiag_html_image_format': 'SVG',
+                                 'seqdiag_html_svg_mode': 'img',
+                                 'seqdiag_html_svgz': True,
+                             })
 
 
 class TestSphinxcontribSeqdiagHTML(unittest.TestCase):
@@ -32,6 +57,20 @@ class TestSphinxcontribSeqdiagHTML(unittest.TestCase):
         self.assertRegexpMatches(source, (r'<div class="align-default">'
                                           r'<img .*? src="_images/.*?.png" .*?/></div>'))
 
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'seqdiag_html_image_loading': 'lazy', 'seqdiag_html_image_decoding': 'async'})
+    def test_build_lazy_png_image(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, (r'<div class="align-default">'
+                                          r'<img decoding="async" height="194" loading="lazy" '
+                                          r'src="_images/.*?.png" width="448" /></div>'))
+
     @with_app(srcdir='tests/docs/subdir', buildername='html', write_docstring=True)
     def test_build_png_image_in_subdir(self, app, status, warning):
         """
@@ -184,7 +223,7 @@ class TestSphinxcontribSeqdiagHTML(unittest.TestCase):
         source = (app.outdir / 'index.html').read_text(encoding='utf-8')
         self.assertRegexpMatches(source, (r'<div class="align-default">'
                                           r'<a class="reference internal image-reference" href="(.*?.png)">'
-                                          r'<map name="(map_\d+)">'
+                                          r'<map name="(map_\w+)">'
                                           r'<area shape="rect" coords="32.0,20.0,96.0,40.0" '
                                           r'href="http://blockdiag.com/"></map>'
                                           r'<img .*? src="\1" usemap="#\2" .*?/></a></div>'))
@@ -204,7 +243,7 @@ class TestSphinxcontribSeqdiagHTML(unittest.TestCase):
         """
         app.builder.build_all()
         source = (app.outdir / 'index.html').read_text(encoding='utf-8')
-        self.assertRegexpMatches(source, (r'<div class="align-default"><map name="(map_\d+)">'
+        self.assertRegexpMatches(source, (r'<div class="align-default"><map name="(map_\w+)">'
                                           r'<area shape="rect" coords="64.0,40.0,192.0,80.0" href="#target"></map>'
                                           r'<img .*? src=".*?.png" usemap="#\1" .*?/></div>'))
 
@@ -223,10 +262,29 @@ class TestSphinxcontribSeqdiagHTML(unittest.TestCase):
         """
         app.builder.build_all()
         source = (app.outdir / 'index.html').read_text(encoding='utf-8')
-        self.assertRegexpMatches(source, (r'<div class="align-default"><map name="(map_\d+)">'
+        self.assertRegexpMatches(source, (r'<div class="align-default"><map name="(map_\w+)">'
                                           r'<area shape="rect" coords="64.0,40.0,192.0,80.0" href="#hello-world">'
                                           r'</map><img .*? src=".*?.png" usemap="#\1" .*?/></div>'))
 
+    @with_png_app
+    def test_map_names_on_png(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+           A [href = 'http://blockdiag.com/'];
+
+        .. seqdiag::
+
+           A -> B;
+           A [href = 'http://blockdiag.com/'];
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        hashed = re.search(r'src="_images/seqdiag-(\w+).png"', source).group(1)[:16]
+        self.assertEqual(['map_%s' % hashed, 'map_%s_2' % hashed], re.findall(r'<map name="(.*?)">', source))
+        self.assertEqual(['#map_%s' % hashed, '#map_%s_2' % hashed], re.findall(r'usemap="(.*?)"', source))
+
     @with_png_app
     def test_missing_reftarget_in_href_on_png(self, app, status, warning):
         """
@@ -241,6 +299,288 @@ class TestSphinxcontribSeqdiagHTML(unittest.TestCase):
                                           r'<img .*? src=".*?.png" .*?/></div>'))
         self.assertIn('undefined label: unknown_target', warning.getvalue())
 
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'seqdiag_html_png_srcset': True, 'seqdiag_png_optimize': True})
+    def test_build_png_image_with_srcset(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, (r'<img height="194" src="_images/(seqdiag-\w+).png" '
+                                          r'srcset="_images/\1.png 1x, _images/\1(@|&#64;)2x.png 2x" '
+                                          r'width="448" />'))
+
+        basename = re.search(r'src="_images/(seqdiag-\w+).png"', source).group(1)
+        image = Image.open(app.outdir / '_images' / (basename + '.png'))
+        self.assertEqual((448, 194), image.size)
+        self.assertEqual('P', image.mode)  # quantized
+        image = Image.open(app.outdir / '_images' / (basename + '@2x.png'))
+        self.assertEqual((896, 388), image.size)
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'seqdiag_antialias': True, 'seqdiag_html_png_srcset': True,
+                             'seqdiag_max_pixels': 100000})
+    def test_build_downsampled_png_image(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, r'<img height="194" src="_images/(seqdiag-\w+).png" width="448" />')
+
+        basename = re.search(r'src="_images/(seqdiag-\w+).png"', source).group(1)
+        image = Image.open(app.outdir / '_images' / (basename + '.png'))
+        self.assertEqual((448, 194), image.size)
+        self.assertFalse(os.path.exists(app.outdir / '_images' / (basename + '@2x.png')))
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'seqdiag_max_pixels': 10000})
+    def test_build_svg_image_for_too_large_diagram(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, r'<div class="align-default"><svg .*?>')
+        self.assertNotIn('<img', source)
+        self.assertIn('448x194 pixels image exceeds seqdiag_max_pixels (10000)', status.getvalue())
+
+    @patch.object(seqdiag_node, 'create_drawer', slow_create_drawer)
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'seqdiag_render_timeout': 1})
+    def test_render_timeout(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B [label = "slow"];
+
+        .. seqdiag::
+
+           A -> B;
+        """
+        started = time.time()
+        app.builder.build_all()
+        self.assertLess(time.time() - started, 30)
+
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertEqual(1, source.count('<img '))
+        self.assertIn('rendering timed out after 1 seconds', warning.getvalue())
+        images = [name for name in os.listdir(app.outdir / '_images') if not name.endswith('.json')]
+        self.assertEqual(1, len(images))  # no stale files are left
+
+    @patch.object(seqdiag_node, 'create_drawer', slow_create_drawer)
+    def test_render_timeout_in_render_server(self):
+        request = dict(command='render', version=get_cache_key(), code='A -> B [label = "slow"];', options={},
+                       format='PNG', antialias=False, transparency=True, references={}, fontpath=[],
+                       fontmap=None, output_options={}, max_pixels=0, inline=False, timeout=1)
+        started = time.time()
+        response = handle_request(request)
+        self.assertLess(time.time() - started, 30)
+        self.assertEqual('rendering timed out after 1 seconds', response['error'])
+
+    @unittest.skipUnless(os.name == 'posix', 'requires Unix domain socket')
+    def test_render_timeout_on_stalled_render_server(self):
+        tmpdir = tempfile.mkdtemp()
+        address = os.path.join(tmpdir, 'seqdiag.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(address)
+        sock.listen(5)  # accepts connections, but never responds
+
+        def build_with(image_format):
+            @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+                      confoverrides={'seqdiag_html_image_format': image_format,
+                                     'seqdiag_render_server': address, 'seqdiag_render_timeout': 1})
+            def build(app, status, warning):
+                """
+                .. seqdiag::
+
+                   A -> B;
+
+                .. seqdiag::
+
+                   A -> C;
+                """
+                started = time.time()
+                app.builder.build_all()
+                self.assertLess(time.time() - started, 30)
+                self.assertIn('rendering timed out after 1 seconds', warning.getvalue())
+
+                # following diagrams are rendered locally
+                source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+                self.assertEqual(1, source.count('<img ') + source.count('<svg '))
+
+            build()
+
+        try:
+            build_with('PNG')
+            build_with('SVG')
+        finally:
+            sock.close()
+            shutil.rmtree(tmpdir)
+
+    @patch.object(seqdiag_node, 'create_drawer', slow_create_drawer)
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'seqdiag_html_image_format': 'SVG', 'seqdiag_render_timeout': 1})
+    def test_render_timeout_on_svg_image(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B [label = "slow"];
+
+        .. seqdiag::
+
+           A -> B;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertEqual(1, source.count('<svg '))
+        self.assertIn('rendering timed out after 1 seconds', warning.getvalue())
+
+    @unittest.skipUnless(is_format_available('WEBP'), "Pillow does not support WebP")
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'seqdiag_html_image_format': 'WEBP'})
+    def test_build_webp_image(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+           A [href = 'http://blockdiag.com/'];
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, (r'<div class="align-default"><map name="(map_\w+)">.*?</map>'
+                                          r'<picture><source srcset="_images/(seqdiag-\w+).webp" type="image/webp" />'
+                                          r'<img height="194" src="_images/\2.png" usemap="#\1" width="448" />'
+                                          r'</picture></div>'))
+
+        basename = re.search(r'src="_images/(seqdiag-\w+).png"', source).group(1)
+        image = Image.open(app.outdir / '_images' / (basename + '.webp'))
+        self.assertEqual(('WEBP', (448, 194)), (image.format, image.size))
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'seqdiag_html_image_format': 'AVIF'})
+    def test_build_avif_image(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        if is_format_available('AVIF'):
+            self.assertRegexpMatches(source, (r'<picture><source srcset="_images/(seqdiag-\w+).avif" '
+                                              r'type="image/avif" /><img .*? src="_images/\1.png" .*?/></picture>'))
+        else:
+            self.assertIn('Could not output AVIF format.', warning.getvalue())
+
+    @with_png_app
+    def test_rebuild_png_image_from_metadata(self, app, status, warning):
+        """
+        .. _target:
+
+        heading2
+        ---------
+
+        .. seqdiag::
+           :scale: 50%
+
+           A -> B;
+           A [href = ':ref:`target`'];
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        with patch("seqdiag.parser.parse_string") as parse_string:
+            app.builder.build_all()
+            self.assertFalse(parse_string.called)
+
+        rebuilt = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertEqual(source, rebuilt)
+
+    @with_png_app
+    def test_parsed_diagrams_are_reused(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+
+        .. seqdiag::
+
+           seqdiag { A -> B; }
+        """
+        parsed_diagrams.clear()  # parsed by other tests
+        with patch("seqdiag.parser.parse_string", wraps=parse_string) as parse:
+            app.builder.build_all()
+            self.assertEqual(2, parse.call_count)  # not parsed again on writing (but retried with "seqdiag { }")
+
+            # parsed diagrams are also stored to the cache directory
+            parsed_diagrams.clear()
+            (app.outdir / '_images').rmtree()
+            app.builder.build_all()
+            self.assertEqual(2, parse.call_count)
+
+        cachedir = app.doctreedir / 'seqdiag'
+        self.assertTrue([name for name in os.listdir(cachedir) if name.endswith('.pickle')])
+
+    @with_svg_app
+    def test_diagram_defaults_on_parsed_diagrams(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           seqdiag { default_note_color = blue; A -> B [note = "x"]; }
+
+        .. seqdiag::
+
+           A -> B [note = "y"];
+        """
+        parsed_diagrams.clear()  # parsed by other tests
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        svgs = re.findall(r'<svg .*?</svg>', source, re.S)
+        self.assertIn('fill="rgb(0,0,255)"', svgs[0])
+        self.assertNotIn('fill="rgb(0,0,255)"', svgs[1])
+
+    @with_svg_app
+    @patch('sphinxcontrib.seqdiag.MAX_SVG_IMAGES', 1)
+    def test_svg_images_are_bounded(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+
+        .. seqdiag::
+
+           A -> B -> C;
+        """
+        svg_images.clear()  # rendered by other tests
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertEqual(2, len(re.findall(r'<svg .*?</svg>', source, re.S)))
+        self.assertEqual(1, len(svg_images))
+
+    @with_png_app
+    def test_missing_reftarget_is_warned_once(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+           A [href = ':ref:`unknown_target`'];
+
+        .. seqdiag::
+
+           A -> B -> C;
+           A [href = ':ref:`unknown_target`'];
+           B [href = ':ref:`unknown_target`'];
+        """
+        app.builder.build_all()
+        self.assertEqual(1, warning.getvalue().count('undefined label: unknown_target'))
+
     @with_svg_app
     def test_build_svg_image(self, app, status, warning):
         """
@@ -252,6 +592,173 @@ class TestSphinxcontribSeqdiagHTML(unittest.TestCase):
         source = (app.outdir / 'index.html').read_text(encoding='utf-8')
         self.assertRegexpMatches(source, r'<div class="align-default"><svg .*?>')
 
+    @with_svg_file_app
+    def test_build_svg_file_image(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, (r'<div class="align-default">'
+                                          r'<img height="194" src="_images/seqdiag-.*?.svg" width="448" /></div>'))
+
+        filename = re.search(r'src="_images/(.*?)"', source).group(1)
+        svg = (app.outdir / '_images' / filename).read_text(encoding='utf-8')
+        with gzip.open(app.outdir / '_images' / (filename + 'z'), 'rt', encoding='utf-8') as f:
+            self.assertEqual(svg, f.read())
+
+    @with_svg_file_app
+    def test_reftarget_in_href_on_svg_file(self, app, status, warning):
+        """
+        .. _target:
+
+        heading2
+        ---------
+
+        .. seqdiag::
+
+           A -> B;
+           A [href = ':ref:`target`'];
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, (r'<div class="align-default">'
+                                          r'<object data="_images/seqdiag-.*?.svg" height="194" '
+                                          r'type="image/svg\+xml" width="448"></object></div>'))
+
+        filename = re.search(r'data="_images/(.*?)"', source).group(1)
+        svg = (app.outdir / '_images' / filename).read_text(encoding='utf-8')
+        self.assertIn('<a target="_top" xlink:href="../index.html#target">', svg)
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'seqdiag_html_image_format': 'SVG', 'seqdiag_html_svg_mode': 'img',
+                             'seqdiag_render_formats': ['PNG']})
+    def test_build_svg_file_image_with_png_fallback(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, (r'<div class="align-default"><picture>'
+                                          r'<source srcset="_images/seqdiag-\w+.svg" type="image/svg\+xml" />'
+                                          r'<img height="194" src="_images/seqdiag-\w+.png" width="448" />'
+                                          r'</picture></div>'))
+
+        filename = re.search(r'src="_images/(.*?)"', source).group(1)
+        self.assertTrue((app.outdir / '_images' / filename).exists())
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'seqdiag_html_image_format': 'SVG', 'seqdiag_html_svg_mode': 'img',
+                             'seqdiag_html_image_loading': 'lazy', 'seqdiag_html_image_decoding': 'async'})
+    def test_build_lazy_svg_file_image(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, (r'<div class="align-default">'
+                                          r'<img decoding="async" height="194" loading="lazy" '
+                                          r'src="_images/seqdiag-.*?.svg" width="448" /></div>'))
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'seqdiag_html_image_format': 'SVG', 'seqdiag_html_image_loading': 'lazy'})
+    def test_build_lazy_svg_image(self, app, status, warning):
+        """
+        .. seqdiag::
+           :scale: 50%
+
+           A -> B;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, (r'<div class="align-default" '
+                                          r'style="content-visibility: auto; contain-intrinsic-size: 224px 97px">'
+                                          r'<svg height="97.0" viewBox="0 0 448 194" width="224.0" .*?>'))
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'seqdiag_html_image_format': 'SVG', 'seqdiag_html_svg_mode': 'img',
+                             'seqdiag_render_formats': ['PNG'], 'seqdiag_max_pixels': 10000})
+    def test_build_svg_file_image_without_png_fallback(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, (r'<div class="align-default">'
+                                          r'<img height="194" src="_images/seqdiag-\w+.svg" width="448" /></div>'))
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'seqdiag_html_image_format': 'SVG', 'seqdiag_svg_minify': True})
+    def test_build_minified_svg_image(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+           A [href = 'http://example.com/'];
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        svg = re.search(r'<svg .*?</svg>', source, re.S).group(0)
+        self.assertNotIn('\n', svg)
+        self.assertNotIn('rgb(', svg)
+        self.assertRegexpMatches(svg, r'<style>.*?\.seqdiag-\w+-\d+{[^}]*font-size:11px;[^}]*}.*?</style>')
+        self.assertRegexpMatches(svg, r'<a xlink:href="http://example.com/"><rect .*? class="seqdiag-\w+-\d+"/>')
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'seqdiag_html_image_format': 'SVG', 'seqdiag_svg_minify': True})
+    def test_links_are_kept_on_minified_svg_image(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+           A [href = 'https://example.com/docs/2.0.1/api.html#v1.50'];
+           B [href = 'https://example.com/rgb(0,0,0)'];
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertIn('<a xlink:href="https://example.com/docs/2.0.1/api.html#v1.50">', source)
+        self.assertIn('<a xlink:href="https://example.com/rgb(0,0,0)">', source)
+
+    @unittest.skipUnless(os.path.exists(seqdiag_fontpath), "TrueType font not found")
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'seqdiag_html_image_format': 'SVG', 'seqdiag_svg_embed_font': True,
+                             'seqdiag_fontpath': seqdiag_fontpath})
+    def test_build_svg_image_with_embedded_font(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, (r'<style>@font-face{font-family:(seqdiag-\w+-font);'
+                                          r'src:url\(data:font/woff;base64,.*?\)}</style>'))
+        self.assertRegexpMatches(source, r'<text .*?font-family="seqdiag-\w+-font,sans-serif"')
+
+    @with_svg_app
+    def test_rebuild_svg_image_from_memo(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B -> C;
+        """
+        app.builder.build_all()
+        with patch("seqdiag.drawer.DiagramDraw.draw") as draw:
+            draw.side_effect = RuntimeError("UNKNOWN ERROR!")
+            app.builder.build_all()
+
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, r'<div class="align-default"><svg .*?>')
+        self.assertNotIn('UNKNOWN ERROR!', warning.getvalue())
+
     @with_svg_app
     def test_width_option_on_svg(self, app, status, warning):
         """
@@ -413,3 +920,295 @@ class TestSphinxcontribSeqdiagHTML(unittest.TestCase):
         app.builder.build_all()
         source = (app.outdir / 'index.html').read_text(encoding='utf-8')
         self.assertRegexpMatches(source, r'<text[^>]+>A_foo</text>')  # 2nd diagram has a node labeled 'A_foo'.
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'seqdiag_prerender': True})
+    def test_prerender_png_images(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+
+        .. seqdiag::
+
+           A -> B;
+        """
+        with patch('sphinxcontrib.seqdiag.render_image', wraps=render_image) as render:
+            app.builder.build_all()
+            self.assertEqual(1, render.call_count)
+
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        images = re.findall(r'<img .*? src="_images/(.*?.png)" .*?/>', source)
+        self.assertEqual(2, len(images))
+        self.assertTrue((app.outdir / '_images' / images[0]).exists())
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'seqdiag_prerender': True})
+    def test_prerender_png_images_with_reftarget(self, app, status, warning):
+        """
+        .. _target:
+
+        heading2
+        ---------
+
+        .. seqdiag::
+
+           A -> B;
+
+        .. seqdiag::
+
+           A -> C;
+           A [href = ':ref:`target`'];
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        images = re.findall(r'<img .*? src="_images/(.*?.png)" .*?/>', source)
+        self.assertEqual(2, len(images))
+        for image in images:
+            self.assertRegexpMatches(status.getvalue(), r'rendering seqdiag images\.\.\. .*%s' % image)
+        self.assertIn('href="#target"', source)
+
+    @with_png_app
+    def test_fontmap_is_not_loaded_without_diagrams(self, app, status, warning):
+        """
+        heading
+        -------
+        """
+        with patch.dict(fontmaps, clear=True):
+            app.builder.build_all()
+            self.assertEqual({}, fontmaps)
+
+    @unittest.skipUnless(os.path.exists(dejavu_fontpath), "TrueType font not found")
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'seqdiag_fontpath': ['/nonexistent/font.ttf', dejavu_fontpath]})
+    def test_detected_font_is_cached(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+        """
+        with patch.dict(fontmaps, clear=True):
+            app.builder.build_all()
+
+        with open(app.doctreedir / 'seqdiag' / 'fonts.json', encoding='utf-8') as f:
+            self.assertEqual([dejavu_fontpath], list(json.load(f).values()))
+
+    @with_png_app
+    def test_remove_unreferenced_images(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+        """
+        stale = app.outdir / '_images' / ('seqdiag-%s.png' % ('0' * 40))
+        stale_metadata = app.outdir / '_images' / ('seqdiag-%s.png.json' % ('0' * 40))
+        stale.parent.makedirs()
+        stale.write_text('')
+        stale_metadata.write_text('')
+
+        app.build()
+        self.assertFalse(stale.exists())
+        self.assertFalse(stale_metadata.exists())
+
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        hashed = re.search(r'src="_images/seqdiag-(\w+).png"', source).group(1)
+        self.assertEqual(['seqdiag-%s.png' % hashed, 'seqdiag-%s.png.json' % hashed],
+                         sorted((app.outdir / '_images').listdir()))
+        self.assertIn('index', app.env.seqdiag_diagrams)
+
+    @unittest.skipUnless(os.path.exists(dejavu_fontpath), "TrueType font not found")
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'seqdiag_html_image_format': 'SVG', 'seqdiag_html_svg_mode': 'img',
+                             'seqdiag_render_formats': ['PNG', 'PDF'], 'seqdiag_fontpath': dejavu_fontpath})
+    def test_extra_images_are_not_published(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+        """
+        app.build()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        fallback = re.search(r'src="_images/(seqdiag-\w+.png)"', source).group(1)
+        images = [name for name in (app.outdir / '_images').listdir() if not name.endswith('.json')]
+        self.assertEqual(['svg', 'png'], sorted([os.path.splitext(name)[1][1:] for name in images], reverse=True))
+        self.assertIn(fallback, images)
+        self.assertTrue([name for name in (app.doctreedir / 'seqdiag').listdir() if name.endswith('.pdf')])
+
+    def test_render_cache(self):
+        cachedir = tempfile.mkdtemp()
+        with_cached_app = with_app(srcdir='tests/docs/basic', buildername='html',
+                                   confoverrides={'seqdiag_cache_dir': cachedir})
+
+        @with_cached_app
+        def build(app, status, warning):
+            app.builder.build_all()
+            # image and its metadata; parsed diagrams are not stored to the shared cache
+            self.assertEqual(2, len(os.listdir(cachedir)))
+
+        @with_cached_app
+        @patch("seqdiag.drawer.DiagramDraw.draw")
+        def rebuild(app, status, warning, draw):
+            app.builder.build_all()
+            self.assertFalse(draw.called)
+            self.assertEqual('', warning.getvalue())
+            self.assertEqual(2, len((app.outdir / '_images').listdir()))
+
+        try:
+            build()
+            rebuild()
+        finally:
+            shutil.rmtree(cachedir)
+
+    def test_render_formats_are_shared_between_builders(self):
+        cachedir = tempfile.mkdtemp()
+        confoverrides = {'seqdiag_cache_dir': cachedir, 'seqdiag_render_formats': ['PNG']}
+
+        @with_app(srcdir='tests/docs/basic', buildername='html',
+                  confoverrides=dict(confoverrides, seqdiag_html_image_format='SVG'))
+        def build(app, status, warning):
+            app.builder.build_all()
+            images = [name for name in os.listdir(cachedir) if name.endswith('.png')]
+            self.assertEqual(1, len(images))
+
+        @with_app(srcdir='tests/docs/basic', buildername='latex', confoverrides=confoverrides)
+        @patch("seqdiag.drawer.DiagramDraw.draw")
+        def rebuild(app, status, warning, draw):
+            app.builder.build_all()
+            self.assertFalse(draw.called)
+            self.assertEqual(1, len([name for name in (app.outdir).listdir() if name.endswith('.png')]))
+
+        try:
+            build()
+            rebuild()
+        finally:
+            shutil.rmtree(cachedir)
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'seqdiag_cache_size': 1})
+    def test_evict_default_cache(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+        """
+        parsed_diagrams.clear()  # parsed by other tests
+        app.builder.build_all()
+        cachedir = app.doctreedir / 'seqdiag'
+        self.assertTrue(os.listdir(cachedir))
+
+        evict_cache(app)
+        self.assertEqual([], os.listdir(cachedir))
+
+    def test_render_formats_on_memoized_svg_image(self):
+        @with_app(srcdir='tests/docs/basic', buildername='html',
+                  confoverrides={'seqdiag_html_image_format': 'SVG'})
+        def build(app, status, warning):
+            app.builder.build_all()
+
+        @with_app(srcdir='tests/docs/basic', buildername='html',
+                  confoverrides={'seqdiag_html_image_format': 'SVG', 'seqdiag_render_formats': ['PNG']})
+        def rebuild(app, status, warning):
+            app.builder.build_all()
+            images = [name for name in (app.doctreedir / 'seqdiag').listdir() if name.endswith('.png')]
+            self.assertEqual(1, len(images))
+            self.assertEqual([], (app.outdir / '_images').listdir())  # not published
+
+        build()
+        rebuild()  # the SVG image is memoized on the first build
+
+    @unittest.skipUnless(os.name == 'posix', 'requires Unix domain socket')
+    def test_render_server(self):
+        tmpdir = tempfile.mkdtemp()
+        address = os.path.join(tmpdir, 'seqdiag.sock')
+        with_server_app = with_app(srcdir='tests/docs/basic', buildername='html',
+                                   confoverrides={'seqdiag_render_server': address})
+
+        @with_server_app
+        @patch("seqdiag.drawer.DiagramDraw.draw")
+        def build(app, status, warning, draw):
+            app.builder.build_all()
+            self.assertFalse(draw.called)  # rendered in the server
+            self.assertEqual('', warning.getvalue())
+            self.assertEqual(2, len((app.outdir / '_images').listdir()))
+            self.assertTrue(os.path.exists(address))
+
+        try:
+            build()
+        finally:
+            send_request(address, dict(command='shutdown'))
+            for _ in range(100):
+                if not os.path.exists(address):
+                    break
+                time.sleep(0.05)
+            self.assertFalse(os.path.exists(address))
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipUnless(os.name == 'posix', 'requires Unix domain socket')
+    def test_render_server_in_shared_directory(self):
+        tmpdir = tempfile.mkdtemp()
+        os.chmod(tmpdir, 0o777)  # other users could replace the socket
+        address = os.path.join(tmpdir, 'seqdiag.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(address)
+            sock.listen(1)
+            with self.assertRaises(PermissionError):
+                send_request(address, dict(command='ping'))
+        finally:
+            sock.close()
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipUnless(os.name == 'posix', 'requires Unix domain socket')
+    def test_render_server_not_responding(self):
+        tmpdir = tempfile.mkdtemp()
+        address = os.path.join(tmpdir, 'seqdiag.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(address)
+            sock.listen(1)
+            with self.assertRaises(socket.timeout):
+                send_request(address, dict(command='ping'), timeout=0.5)
+        finally:
+            sock.close()
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipUnless(os.name == 'posix', 'requires Unix domain socket')
+    def test_default_address_of_render_server(self):
+        tmpdir = tempfile.mkdtemp()
+        with_server_app = with_app(srcdir='tests/docs/basic', buildername='html',
+                                   confoverrides={'seqdiag_render_server': True})
+
+        @with_server_app
+        def build(app, status, warning):
+            with patch.dict(os.environ, XDG_RUNTIME_DIR=tmpdir):
+                server = get_render_server(app.builder)
+                self.assertEqual(tmpdir, os.path.dirname(server.address))
+
+        try:
+            build()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'seqdiag_profile': True})
+    def test_profile_report(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+
+        .. seqdiag::
+
+           A -> B -> C;
+        """
+        app.build()
+        with open(app.outdir / 'seqdiag-profile.json', encoding='utf-8') as f:
+            records = json.load(f)
+
+        self.assertEqual(2, len(records))
+        self.assertGreaterEqual(records[0]['total'], records[1]['total'])
+        for record in records:
+            self.assertEqual('index', record['docname'])
+            self.assertEqual(os.path.getsize(app.outdir / '_images' / record['image']), record['size'])
+        self.assertEqual([2, 6], sorted(record['line'] for record in records))
+        self.assertTrue((app.outdir / 'seqdiag-profile.csv').exists())
@@ -2,7 +2,11 @@
 
 import os
 import re
+from mock import patch
+from reportlab.pdfbase.ttfonts import TTFont
 from sphinx_testing import with_app
+from sphinxcontrib.seqdiag import seqdiag_node
+from tests import slow_create_drawer
 
 import unittest
 
@@ -31,6 +35,13 @@ with_oldpdf_app = with_app(srcdir='tests/docs/basic',
                                'latex_documents': [('index', 'test.tex', '', 'test', 'manual')],
                                'seqdiag_fontpath': seqdiag_fontpath,
                            })
+with_parallel_app = with_app(srcdir='tests/docs/basic',
+                             buildername='latex',
+                             write_docstring=True,
+                             confoverrides={
+                                 'seqdiag_render_workers': 2,
+                                 'latex_documents': [('index', 'test.tex', '', 'test', 'manual')],
+                             })
 
 
 class TestSphinxcontribSeqdiagLatex(unittest.TestCase):
@@ -44,6 +55,7 @@ class TestSphinxcontribSeqdiagLatex(unittest.TestCase):
         app.builder.build_all()
         source = (app.outdir / 'test.tex').read_text(encoding='utf-8')
         self.assertRegexpMatches(source, r'\\sphinxincludegraphics{{seqdiag-.*?}.png}')
+        self.assertFalse([name for name in os.listdir(app.outdir) if name.endswith('.json')])
 
     @unittest.skipUnless(os.path.exists(seqdiag_fontpath), "TrueType font not found")
     @with_pdf_app
@@ -69,6 +81,62 @@ class TestSphinxcontribSeqdiagLatex(unittest.TestCase):
         source = (app.outdir / 'test.tex').read_text(encoding='utf-8')
         self.assertRegexpMatches(source, r'\\sphinxincludegraphics{{seqdiag-.*?}.pdf}')
 
+    @unittest.skipUnless(os.path.exists(seqdiag_fontpath), "TrueType font not found")
+    @with_pdf_app
+    @patch("blockdiag.imagedraw.pdf.TTFont", wraps=TTFont)
+    def test_build_pdf_images_with_shared_fonts(self, app, status, warning, ttfont):
+        """
+        .. seqdiag::
+
+           A -> B;
+
+        .. seqdiag::
+
+           A -> B -> C;
+        """
+        app.builder.build_all()
+        self.assertLessEqual(ttfont.call_count, 1)  # font is loaded only once
+        self.assertEqual(2, len([name for name in app.outdir.listdir() if name.endswith('.pdf')]))
+
+    @unittest.skipUnless(os.path.exists(seqdiag_fontpath), "TrueType font not found")
+    @with_app(srcdir='tests/docs/basic', buildername='latex', write_docstring=True,
+              confoverrides={
+                  'seqdiag_max_pixels': 10000,
+                  'latex_documents': [('index', 'test.tex', '', 'test', 'manual')],
+                  'seqdiag_fontpath': seqdiag_fontpath,
+              })
+    def test_build_pdf_image_for_too_large_diagram(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'test.tex').read_text(encoding='utf-8')
+        self.assertRegexpMatches(source, r'\\sphinxincludegraphics{{seqdiag-.*?}.pdf}')
+        self.assertEqual(1, len([name for name in app.outdir.listdir() if name.endswith('.pdf')]))
+
+    @patch.object(seqdiag_node, 'create_drawer', slow_create_drawer)
+    @with_app(srcdir='tests/docs/basic', buildername='latex', write_docstring=True,
+              confoverrides={
+                  'seqdiag_render_timeout': 1,
+                  'latex_documents': [('index', 'test.tex', '', 'test', 'manual')],
+              })
+    def test_render_timeout(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B [label = "slow"];
+
+        .. seqdiag::
+
+           A -> B;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'test.tex').read_text(encoding='utf-8')
+        self.assertEqual(1, len(re.findall(r'\\sphinxincludegraphics', source)))
+        self.assertIn('rendering timed out after 1 seconds', warning.getvalue())
+
     @with_png_app
     def test_width_option(self, app, status, warning):
         """
@@ -194,3 +262,26 @@ class TestSphinxcontribSeqdiagLatex(unittest.TestCase):
         app.builder.build_all()
         source = (app.outdir / 'test.tex').read_text(encoding='utf-8')
         self.assertRegexpMatches(source, r'\\sphinxincludegraphics{{seqdiag-.*?}.png}')
+
+    @with_parallel_app
+    def test_build_png_image_in_parallel(self, app, status, warning):
+        """
+        .. seqdiag::
+
+           A -> B;
+
+        .. seqdiag::
+
+           A -> C;
+
+        .. seqdiag::
+
+           { A -> B;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'test.tex').read_text(encoding='utf-8')
+        images = re.findall(r'\\sphinxincludegraphics{{(seqdiag-.*?)}.png}', source)
+        self.assertEqual(2, len(images))
+        for image in images:
+            self.assertTrue((app.outdir / (image + '.png')).exists())
+        self.assertIn('got unexpected token:', warning.getvalue())
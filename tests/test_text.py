@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+from mock import patch
+from sphinx_testing import with_app
+
+import unittest
+
+with_text_app = with_app(srcdir='tests/docs/basic',
+                         buildername='text',
+                         write_docstring=True)
+
+
+class TestSphinxcontribSeqdiagText(unittest.TestCase):
+    @with_text_app
+    @patch("seqdiag.drawer.DiagramDraw.draw")
+    def test_build_source_code(self, app, status, warning, draw):
+        """
+        .. seqdiag::
+
+           A -> B;
+           B -> C;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.txt').read_text(encoding='utf-8')
+        self.assertEqual('   A -> B;\n   B -> C;\n', source)
+        self.assertFalse(draw.called)
+        self.assertFalse((app.outdir / '_images').exists())
+
+    @with_text_app
+    def test_build_alt_text(self, app, status, warning):
+        """
+        .. seqdiag::
+           :alt: hello world
+
+           A -> B;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.txt').read_text(encoding='utf-8')
+        self.assertIn('hello world', source)
+        self.assertNotIn('A -> B;', source)
+
+    @with_app(srcdir='tests/docs/basic', buildername='text', write_docstring=True,
+              confoverrides={'seqdiag_builder_capabilities': {'text': 'none'}})
+    def test_remove_diagrams(self, app, status, warning):
+        """
+        .. seqdiag::
+           :alt: hello world
+
+           A -> B;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.txt').read_text(encoding='utf-8')
+        self.assertNotIn('hello world', source)
+        self.assertNotIn('A -> B;', source)
+
+    @with_app(srcdir='tests/docs/basic', buildername='dummy', write_docstring=True)
+    @patch("seqdiag.drawer.DiagramDraw.draw")
+    def test_skip_rendering_on_dummy_builder(self, app, status, warning, draw):
+        """
+        .. seqdiag::
+
+           A -> B;
+        """
+        app.builder.build_all()
+        self.assertFalse(draw.called)
+        self.assertEqual('', warning.getvalue())
+
+    @with_app(srcdir='tests/docs/basic', buildername='html', write_docstring=True,
+              confoverrides={'seqdiag_builder_capabilities': {'html': 'alt'}})
+    @patch("seqdiag.drawer.DiagramDraw.draw")
+    def test_override_capability_of_html_builder(self, app, status, warning, draw):
+        """
+        .. seqdiag::
+
+           A -> B;
+        """
+        app.builder.build_all()
+        source = (app.outdir / 'index.html').read_text(encoding='utf-8')
+        self.assertIn('A -&gt; B;', source)
+        self.assertFalse(draw.called)